@@ -25,11 +25,25 @@
 import pandas as pd
 import numpy as np
 import time
+import os
+import re
+import json
+import shutil
+import threading
+import datetime
+import math
+import warnings
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import pyspark.sql.functions as F
 from pyspark.sql.functions import col
-from pyspark.sql.types import DateType, TimestampType
+from pyspark.sql.types import DateType, DoubleType, TimestampType
 from pyspark.sql.window import Window
+from pyspark.ml.feature import Bucketizer
 from pyspark.sql.types import IntegerType
+from pyspark import StorageLevel
 
 # COMMAND ----------
 
@@ -42,7 +56,23 @@ from pyspark.sql.types import IntegerType
 # As tabelas serão necessárias para a realização da 'EDA'.
 
 class DatabricksSnowflakeConnection:
-    def __init__(self, host, user, password, dw, db, schema, table):
+    def __init__(
+        self,
+        host,
+        user,
+        password,
+        dw,
+        db,
+        schema,
+        table,
+        source_format="snowflake",
+        pool_size=4,
+        idle_timeout=600,
+        stage_cache=None,
+        bulk_stage=None,
+        prefetch_workers=3,
+        extra_options=None,
+    ):
         self.host = host
         self.user = user
         self.password = password
@@ -50,83 +80,1169 @@ class DatabricksSnowflakeConnection:
         self.db = db
         self.schema = schema
         self.table = table
-        options1 = {
-            "host": self.host,
-            "user": self.user,
-            "password": self.password,
-            "sfWarehouse": self.dw,
-            "database": self.db,
-            "schema": self.schema,
+        self.source_format = source_format
+        self.stage_cache = stage_cache
+        self.bulk_stage = bulk_stage
+        self._prefetch = ThreadPoolExecutor(max_workers=prefetch_workers)
+        self.options = {
+            **self._validate_options(
+                {
+                    "host": self.host,
+                    "user": self.user,
+                    "password": self.password,
+                    "sfWarehouse": self.dw,
+                }
+            ),
+            **(extra_options or {}),
         }
-        try:
-            connection = (
-                spark.read.format("snowflake")
-                .options(**options1)
-                .option("dbtable", self.table)
-                .load()
+        self._options_cache = {}
+        self._connected = None
+        self.pool = SnowflakeSessionPool(
+            self._handshake, size=pool_size, idle_timeout=idle_timeout
+        )
+
+    def _validate_options(self, options):
+        missing = [key for key, value in options.items() if not value]
+        if missing:
+            raise ValueError(f"Missing connection options: {missing}")
+        return options
+
+    def _options_for(self, db, schema):
+        # As opções de cada par (database, schema) são construídas e validadas uma única vez.
+        key = (db, schema)
+        if key not in self._options_cache:
+            self._options_cache[key] = {
+                **self.options,
+                **self._validate_options({"database": db, "schema": schema}),
+            }
+        return self._options_cache[key]
+
+    def _handshake(self, options):
+        # Abre e autentica a ligação JDBC da sessão: no SF através do conector ('Utils.getJDBCConnection'), nas outras fontes através do 'DriverManager' e do 'url' de 'extra_options'.
+        if self.source_format == "snowflake":
+            connection = spark._jvm.net.snowflake.spark.snowflake.Utils.getJDBCConnection(
+                options
             )
-            return print(
-                "Connection between Databricks and Snowflake executed successfully"
+        else:
+            properties = spark._jvm.java.util.Properties()
+            for key in ("user", "password"):
+                properties.setProperty(key, options[key])
+            connection = spark._jvm.java.sql.DriverManager.getConnection(
+                options["url"], properties
             )
-        except:
-            print("Connection between Databricks and Snowflake failed")
-
-    def read_table(self, db_read, schema_read, table_read, query=None, type=True):
-        options2 = {
-            "host": self.host,
-            "user": self.user,
-            "password": self.password,
-            "sfWarehouse": self.dw,
-            "database": db_read,
-            "schema": schema_read,
-        }
+        if not connection.isValid(30):
+            connection.close()
+            raise ConnectionError("The JDBC connection is not valid")
+        return connection
+
+    @contextmanager
+    def _session(self, db, schema, call):
+        with self.pool.session(
+            (self.dw, db, schema), self._options_for(db, schema), call
+        ) as session:
+            yield session
+
+    def check_connection(self):
         try:
-            if type == True:
-                df = (
-                    spark.read.format("snowflake")
-                    .options(**options2)
-                    .option("dbtable", table_read)
-                    .load()
+            with self._session(self.db, self.schema, "check_connection"):
+                pass
+            print("Connection between Databricks and Snowflake executed successfully")
+            return True
+        except Exception as e:
+            print("Connection between Databricks and Snowflake failed")
+            print(f"Error description: {e}")
+            return False
+
+    def connect(self):
+        if self._connected is None:
+            self._connected = self.check_connection()
+        return self._connected
+
+    def table_stats(self, db, schema, table):
+        # Estatísticas mantidas pelo próprio SF para a tabela (número de linhas, 'bytes' e data da última alteração), obtidas apenas a partir dos metadados.
+        # Nas outras fontes ('jdbc') a existência da tabela é verificada nos metadados JDBC e o número de linhas é contado; 'bytes' e 'LAST_ALTERED' ficam vazios.
+        # Os nomes são validados ('_sql_identifier') e comparados em maiúsculas, tal como o SF guarda os identificadores sem aspas.
+        db_name, schema_name, table_name = (
+            _sql_identifier(name).upper() for name in (db, schema, table)
+        )
+        with self._session(db, schema, "table_stats") as session:
+            if self.source_format == "snowflake":
+                rows = _fetch_rows(
+                    session.connection,
+                    f"SELECT ROW_COUNT, BYTES, LAST_ALTERED FROM {db_name}.INFORMATION_SCHEMA.TABLES "
+                    f"WHERE TABLE_SCHEMA = '{schema_name}' AND TABLE_NAME = '{table_name}'",
                 )
-                return df
             else:
-                df = (
-                    spark.read.format("snowflake")
-                    .options(**options2)
-                    .option("query", query)
-                    .load()
+                tables = session.connection.getMetaData().getTables(
+                    None, schema_name, table_name, None
                 )
+                rows = []
+                if tables.next():
+                    rows = _fetch_rows(
+                        session.connection,
+                        f"SELECT COUNT(*) AS ROW_COUNT FROM {schema_name}.{table_name}",
+                    )
+                    rows[0].update({"BYTES": None, "LAST_ALTERED": None})
+                tables.close()
+        if not rows:
+            return None
+        stats = rows[0]
+        for column in ("ROW_COUNT", "BYTES"):
+            if stats[column] is not None:
+                stats[column] = int(stats[column])
+        return stats
+
+    def table_fingerprint(self, db, schema, table):
+        # Impressão digital da tabela no SF: data da última alteração ('LAST_ALTERED'). Sem essa data (fontes 'jdbc') não há impressão digital e a cópia local nunca é considerada atualizada.
+        stats = self.table_stats(db, schema, table)
+        return str(stats["LAST_ALTERED"]) if stats and stats["LAST_ALTERED"] else None
+
+    def _stage_key(self, db, schema, table):
+        return f"{db}.{schema}.{table}".upper()
+
+    def build_query(self, table, columns=None, where=None):
+        # Os nomes das colunas/tabela são validados e os valores são convertidos em literais SQL, pelo que a 'query' nunca contém texto livre.
+        select = ", ".join(_sql_identifier(column) for column in columns) if columns else "*"
+        query = f"SELECT {select} FROM {_sql_identifier(table)}"
+        if where:
+            query += " WHERE " + " AND ".join(
+                _sql_predicate(*predicate) for predicate in where
+            )
+        return query
+
+    def _read_staged(self, db, schema, table):
+        key = self._stage_key(db, schema, table)
+        fingerprint = self.table_fingerprint(db, schema, table)
+        if not self.stage_cache.is_fresh(key, fingerprint):
+            df = (
+                spark.read.format(self.source_format)
+                .options(**self._options_for(db, schema))
+                .option("dbtable", table)
+                .load()
+            )
+            self.stage_cache.write(df, key, fingerprint)
+        return self.stage_cache.read(key)
+
+    def read_table(
+        self,
+        db_read,
+        schema_read,
+        table_read,
+        columns=None,
+        where=None,
+        prefer_cache=False,
+        raise_errors=False,
+    ):
+        try:
+            if prefer_cache and self.stage_cache is not None:
+                # A cópia local é completa: as colunas e os predicados são aplicados pelo Spark sobre o Parquet.
+                df = self._read_staged(db_read, schema_read, table_read)
+                if where:
+                    df = df.filter(_spark_predicates(where))
+                if columns:
+                    df = df.select(*columns)
                 return df
+            reader = spark.read.format(self.source_format).options(
+                **self._options_for(db_read, schema_read)
+            )
+            if columns or where:
+                reader = reader.option(
+                    "query", self.build_query(table_read, columns, where)
+                )
+            else:
+                reader = reader.option("dbtable", table_read)
+            df = reader.load()
+            return df
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"Error description: {e}")
 
-    def write_table(self, df, db_write, schema_write, table_write):
-        options3 = {
-            "host": self.host,
-            "user": self.user,
-            "password": self.password,
-            "sfWarehouse": self.dw,
-            "database": db_write,
-            "schema": schema_write,
-        }
+    def read_table_async(self, *args, persist=False, **kwargs):
+        def read():
+            spark.sparkContext.setLocalProperty("spark.scheduler.pool", "prefetch")
+            try:
+                df = self.read_table(*args, raise_errors=True, **kwargs)
+                if persist:
+                    df = df.persist()
+                    df.count()
+                return df
+            finally:
+                spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
+
+        return self._prefetch.submit(read)
+
+    def write_table(
+        self,
+        df,
+        db_write,
+        schema_write,
+        table_write,
+        raise_errors=False,
+        stage=False,
+        mode="errorifexists",
+        bulk=False,
+    ):
         try:
+            stage = stage and self.stage_cache is not None and mode != "append"
+            bulk = bulk and self.bulk_stage is not None
+            # As estatísticas antes da escrita só são necessárias em 'append'; nos restantes modos a tabela fica apenas com as linhas escritas.
+            stats_before = {}
+            if mode == "append":
+                stats_before = self.table_stats(db_write, schema_write, table_write) or {}
             start_time = time.time()
-            df.write.format("snowflake").options(**options3).option("dbtable", table_write).save()
+            if stage:
+                key = self._stage_key(db_write, schema_write, table_write)
+                self.stage_cache.write(df, key)
+                df = self.stage_cache.read(key)
+            phases = {}
+            if bulk:
+                phases = self._bulk_write(df, db_write, schema_write, table_write, mode)
+            else:
+                df.write.format(self.source_format).options(**self._options_for(db_write, schema_write)).option("dbtable", table_write).mode(mode).save()
             end_time = time.time()
+            stats_after = self.table_stats(db_write, schema_write, table_write) or {}
+            # Sem 'LAST_ALTERED' (fontes 'jdbc') a cópia local fica sem impressão digital, em vez de guardar o texto 'None'.
+            if stage and stats_after.get("LAST_ALTERED") is not None:
+                self.stage_cache.set_fingerprint(key, str(stats_after["LAST_ALTERED"]))
             time_total = end_time - start_time
             time_total_rounded = round(time_total, 2)
             dict_info_tabela = {
                 "Tempo total transcorrido (segundos)": time_total_rounded,
-                "Schema": self.schema,
+                "Schema": schema_write,
                 "Tabela": table_write,
                 "Numero de columnas": len(df.columns),
                 "nome das colunas": df.columns,
-                "Numero de linhas": df.count(),
+                "Numero de linhas": (stats_after.get("ROW_COUNT") or 0)
+                - (stats_before.get("ROW_COUNT") or 0),
+                "Bytes": (stats_after.get("BYTES") or 0) - (stats_before.get("BYTES") or 0),
+                **phases,
             }
             return dict_info_tabela
         except Exception as e:
+            if raise_errors:
+                raise
+            print(f"Error description: {e}")
+
+    def write_table_checkpointed(
+        self,
+        df,
+        db_write,
+        schema_write,
+        table_write,
+        checkpoints,
+        chunks=16,
+        retry=None,
+        mode="errorifexists",
+        stage=False,
+        bulk=False,
+    ):
+        retry = retry or RetryPolicy()
+        key = self._stage_key(db_write, schema_write, table_write)
+        previous = checkpoints.state().get(key)
+        if (
+            mode == "errorifexists"
+            and previous is not None
+            and previous["status"] == "completo"
+            and previous["chunks"] == chunks
+        ):
+            # A tabela já foi escrita por completo numa execução anterior: uma nova execução (por exemplo ao voltar a correr o 'notebook') não volta a criá-la.
+            stats = self.table_stats(db_write, schema_write, table_write) or {}
+            return {
+                "Tempo total transcorrido (segundos)": 0.0,
+                "Schema": schema_write,
+                "Tabela": table_write,
+                "Numero de columnas": len(df.columns),
+                "nome das colunas": df.columns,
+                "Numero de linhas": stats.get("ROW_COUNT") or 0,
+                "Partes": chunks,
+                "Partes escritas": 0,
+                "Partes já escritas": chunks,
+            }
+        run = checkpoints.start(key, chunks)
+        stage = stage and self.stage_cache is not None
+        bulk = bulk and self.bulk_stage is not None
+        table = _sql_identifier(table_write)
+        chunk_path = checkpoints.chunk_path(key)
+        start_time = time.time()
+        # As linhas são divididas uma única vez numa cópia local em Parquet particionada por parte ('_CHUNK'): cada parte lê apenas a sua partição e uma execução retomada lê as mesmas linhas nas mesmas partes.
+        if not run["staged"]:
+            if stage:
+                self.stage_cache.write(df, key)
+                df = self.stage_cache.read(key)
+            df.withColumn("_CHUNK", F.pmod(F.hash(*df.columns), F.lit(chunks))).write.mode(
+                "overwrite"
+            ).partitionBy("_CHUNK").parquet(_spark_path(chunk_path))
+            checkpoints.update(key, staged=True)
+        chunked = spark.read.parquet(_spark_path(chunk_path))
+        written = 0
+
+        def on_retry(attempt, error):
+            checkpoints.record_retry(key, error)
+
+        try:
+            if not run["created"]:
+                # Com 'errorifexists', uma tabela vazia que já existe foi criada por uma execução interrompida antes de o 'checkpoint' registar a criação e é reaproveitada.
+                existing = self.table_stats(db_write, schema_write, table_write)
+                if not (mode == "errorifexists" and existing and not existing.get("ROW_COUNT")):
+                    retry.run(
+                        lambda: self._create_table(
+                            df, db_write, schema_write, table, mode
+                        ),
+                        on_retry,
+                    )
+                baseline = (existing or {}).get("ROW_COUNT") if mode == "append" else 0
+                checkpoints.update(key, created=True, baseline_rows=baseline or 0)
+                if bulk:
+                    retry.run(
+                        lambda: self._clear_bulk_stage(db_write, schema_write, table),
+                        on_retry,
+                    )
+            for chunk in range(chunks):
+                if chunk in run["done"]:
+                    continue
+                chunk_df = chunked.filter(F.col("_CHUNK") == chunk).drop("_CHUNK")
+                if bulk:
+                    # Cada parte apenas envia os seus ficheiros para o 'stage' da tabela; as linhas são carregadas no fim, por um único 'COPY INTO'.
+                    _, files = retry.run(
+                        lambda: self._bulk_upload(chunk_df, db_write, schema_write, table),
+                        on_retry,
+                    )
+                    checkpoints.mark_done(key, chunk, files)
+                else:
+                    retry.run(
+                        lambda: self._append_chunk(
+                            chunk_df, db_write, schema_write, table
+                        ),
+                        on_retry,
+                    )
+                    checkpoints.mark_done(key, chunk)
+                written += 1
+            if bulk and not checkpoints.state()[key].get("copied"):
+                files = [
+                    file
+                    for chunk_files in checkpoints.state()[key]["files"].values()
+                    for file in chunk_files
+                ]
+                retry.run(
+                    lambda: self._bulk_copy(
+                        db_write, schema_write, table, files, df.schema, purge=False
+                    ),
+                    on_retry,
+                )
+                checkpoints.update(key, copied=True)
+                self._clear_bulk_stage(db_write, schema_write, table)
+        except Exception as e:
+            checkpoints.update(key, status="falhou", error=str(e))
+            raise
+        checkpoints.update(key, status="completo", error=None)
+        shutil.rmtree(chunk_path, ignore_errors=True)
+        stats = self.table_stats(db_write, schema_write, table_write) or {}
+        if stage and stats.get("LAST_ALTERED") is not None:
+            self.stage_cache.set_fingerprint(key, str(stats["LAST_ALTERED"]))
+        return {
+            "Tempo total transcorrido (segundos)": round(time.time() - start_time, 2),
+            "Schema": schema_write,
+            "Tabela": table_write,
+            "Numero de columnas": len(df.columns),
+            "nome das colunas": df.columns,
+            "Numero de linhas": (stats.get("ROW_COUNT") or 0)
+            - checkpoints.state()[key].get("baseline_rows", 0),
+            "Partes": chunks,
+            "Partes escritas": written,
+            "Partes já escritas": len(run["done"]),
+        }
+
+    def _create_table(self, df, db_write, schema_write, table, mode):
+        df.limit(0).write.format(self.source_format).options(**self._options_for(db_write, schema_write)).option("dbtable", table).mode(mode).save()
+
+    def _append_chunk(self, df, db_write, schema_write, table):
+        df.write.format(self.source_format).options(**self._options_for(db_write, schema_write)).option("dbtable", table).mode("append").save()
+
+    def _clear_bulk_stage(self, db_write, schema_write, table):
+        if self.source_format == "snowflake":
+            self.run_query(db_write, schema_write, f"REMOVE @%{table}")
+        else:
+            self.bulk_stage.clear(table)
+
+    def _bulk_write(self, df, db_write, schema_write, table_write, mode):
+        table = _sql_identifier(table_write)
+        # A tabela é criada (ou substituída, conforme 'mode') com o 'schema' do DataFrame e sem linhas, pelo próprio conector.
+        self._create_table(df, db_write, schema_write, table, mode)
+        phases, files = self._bulk_upload(df, db_write, schema_write, table, clear_stage=True)
+        start_time = time.time()
+        self._bulk_copy(db_write, schema_write, table, files, df.schema)
+        phases["COPY (segundos)"] = round(time.time() - start_time, 2)
+        return phases
+
+    def _bulk_upload(self, df, db_write, schema_write, table, clear_stage=False):
+        # Grava os ficheiros comprimidos e envia-os para o 'stage' da tabela; devolve as fases cronometradas e os nomes dos ficheiros enviados.
+        bulk_stage = self.bulk_stage
+        phases = {}
+        start_time = time.time()
+        files = bulk_stage.write(df, table)
+        phases["Escrita da staging (segundos)"] = round(time.time() - start_time, 2)
+        phases["Ficheiros"] = len(files)
+        phases["Bytes da staging"] = sum(os.path.getsize(path) for path in files)
+        try:
+            start_time = time.time()
+            uploaded = bulk_stage.uploaded_path_for(table)
+            # Ficheiros deixados no 'stage' da tabela por uma tentativa anterior que falhou são apagados antes do envio, para que não sejam carregados outra vez.
+            if self.source_format == "snowflake":
+                if clear_stage:
+                    self.run_query(db_write, schema_write, f"REMOVE @%{table}")
+                upload = lambda path: self.run_query(
+                    db_write,
+                    schema_write,
+                    f"PUT file://{path} @%{table} AUTO_COMPRESS=FALSE OVERWRITE=TRUE",
+                )
+            else:
+                if clear_stage:
+                    shutil.rmtree(uploaded, ignore_errors=True)
+                os.makedirs(uploaded, exist_ok=True)
+                upload = lambda path: shutil.copy(path, uploaded)
+            with ThreadPoolExecutor(max_workers=bulk_stage.max_workers) as executor:
+                list(executor.map(upload, files))
+            phases["Upload (segundos)"] = round(time.time() - start_time, 2)
+        finally:
+            shutil.rmtree(bulk_stage.path_for(table), ignore_errors=True)
+        return phases, [os.path.basename(path) for path in files]
+
+    def _bulk_copy(self, db_write, schema_write, table, files, schema, purge=True):
+        # Carrega apenas os ficheiros indicados ('FILES'). Sem 'purge' os ficheiros ficam no 'stage': um 'COPY' repetido ignora os ficheiros já carregados (metadados de carregamento do SF).
+        bulk_stage = self.bulk_stage
+        if self.source_format == "snowflake":
+            uploaded_files = ", ".join(_sql_literal(file) for file in files)
+            self.run_query(
+                db_write,
+                schema_write,
+                f"COPY INTO {table} FROM @%{table} FILES = ({uploaded_files}) "
+                f"{bulk_stage.copy_options()} PURGE = {'TRUE' if purge else 'FALSE'}",
+            )
+        else:
+            uploaded = bulk_stage.uploaded_path_for(table)
+            bulk_stage.read_uploaded(
+                schema, table, [os.path.join(uploaded, file) for file in files]
+            ).write.format(self.source_format).options(**self._options_for(db_write, schema_write)).option("dbtable", table).mode("append").save()
+            if purge:
+                bulk_stage.clear(table)
+
+    def run_query(self, db, schema, query):
+        with self._session(db, schema, "run_query") as session:
+            statement = session.connection.createStatement()
+            try:
+                statement.execute(query)
+            finally:
+                statement.close()
+
+    def merge_table(
+        self, df, db_write, schema_write, table_write, keys, raise_errors=False
+    ):
+        try:
+            # O 'MERGE' exige uma única linha por chave na origem. As linhas repetidas por completo são enviadas uma única vez; linhas diferentes com a mesma chave não são descartadas: o 'MERGE' falha e indica quantas chaves estão repetidas (a chave tem de ser alargada).
+            # As chaves com valores nulos nas linhas a enviar são comparadas com 'NULL' = 'NULL'; as restantes com uma igualdade simples, que permite ao SF fazer um 'hash join'.
+            df = df.dropDuplicates()
+            duplicated = df.groupBy(*keys).count().filter(F.col("count") > 1).count()
+            if duplicated:
+                raise ValueError(
+                    f"{duplicated} keys {tuple(keys)} have more than one distinct row in the source of {table_write}"
+                )
+            has_nulls = df.agg(
+                *[F.max(F.col(key).isNull()).alias(key) for key in keys]
+            ).collect()[0]
+            columns = [_sql_identifier(column) for column in df.columns]
+            keys = [_sql_identifier(key) for key in keys]
+            target = _sql_identifier(table_write)
+            stage_table = _sql_identifier(f"{table_write}_STAGE")
+            stats_before = self.table_stats(db_write, schema_write, table_write) or {}
+            start_time = time.time()
+            staged = self.write_table(
+                df, db_write, schema_write, stage_table, raise_errors=True, mode="overwrite"
+            )
+            on = " AND ".join(
+                f"(T.{key} = S.{key} OR (T.{key} IS NULL AND S.{key} IS NULL))"
+                if has_nulls[key]
+                else f"T.{key} = S.{key}"
+                for key in keys
+            )
+            update = ", ".join(
+                f"{column} = S.{column}" for column in columns if column not in keys
+            )
+            query = (
+                f"MERGE INTO {target} T USING {stage_table} S ON {on} "
+                + (f"WHEN MATCHED THEN UPDATE SET {update} " if update else "")
+                + f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) "
+                f"VALUES ({', '.join('S.' + column for column in columns)})"
+            )
+            try:
+                self.run_query(db_write, schema_write, query)
+            finally:
+                self.run_query(db_write, schema_write, f"DROP TABLE {stage_table}")
+            end_time = time.time()
+            stats_after = self.table_stats(db_write, schema_write, table_write) or {}
+            inserted = (stats_after.get("ROW_COUNT") or 0) - (
+                stats_before.get("ROW_COUNT") or 0
+            )
+            return {
+                "Tempo total transcorrido (segundos)": round(end_time - start_time, 2),
+                "Schema": schema_write,
+                "Tabela": table_write,
+                "Linhas na staging": staged["Numero de linhas"],
+                "Linhas inseridas": inserted,
+                "Linhas atualizadas": staged["Numero de linhas"] - inserted,
+            }
+        except Exception as e:
+            if raise_errors:
+                raise
             print(f"Error description: {e}")
 
+
+# '_fetch_rows' executa uma 'query' numa ligação JDBC e devolve as linhas como dicionários (coluna -> valor). Valores sem tipo Python equivalente (por exemplo datas do Java) são convertidos em texto.
+
+def _fetch_rows(connection, query):
+    statement = connection.createStatement()
+    try:
+        result = statement.executeQuery(query)
+        metadata = result.getMetaData()
+        columns = [metadata.getColumnLabel(i + 1) for i in range(metadata.getColumnCount())]
+        rows = []
+        while result.next():
+            row = {}
+            for i, column in enumerate(columns):
+                value = result.getObject(i + 1)
+                row[column] = str(value) if hasattr(value, "getClass") else value
+            rows.append(row)
+        return rows
+    finally:
+        statement.close()
+
+
+# Predicados estruturados de 'read_table': cada predicado é um tuplo (coluna, operador, valor), e os predicados da lista são combinados com 'AND'.
+# Operadores suportados: '=', '!=', '<', '<=', '>', '>=', 'in', 'not in' (valor = lista), 'is null' e 'is not null' (sem valor).
+# '_sql_predicate' gera o SQL enviado ao SF e '_spark_predicates' gera a expressão equivalente do Spark (utilizada na leitura a partir da cache).
+# Uma lista vazia não gera 'IN ()', que não é SQL válido: 'in' com lista vazia é sempre falso ('FALSE') e 'not in' com lista vazia é sempre verdadeiro ('TRUE').
+# Os números não finitos ('NaN', 'inf' e '-inf') não têm literal em SQL e são rejeitados ('ValueError').
+
+PREDICATE_OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "in", "not in", "is null", "is not null")
+
+
+def _sql_identifier(name):
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_$]*", name):
+        raise ValueError(f"Invalid identifier: {name!r}")
+    return name
+
+
+def _sql_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"Non-finite number in predicate: {value!r}")
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return f"'{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _sql_predicate(column, operator, value=None):
+    operator = operator.lower()
+    if operator not in PREDICATE_OPERATORS:
+        raise ValueError(f"Unsupported operator: {operator!r}")
+    column = _sql_identifier(column)
+    if operator in ("is null", "is not null"):
+        return f"{column} {operator.upper()}"
+    if operator in ("in", "not in"):
+        values = list(value)
+        if not values:
+            return "FALSE" if operator == "in" else "TRUE"
+        return f"{column} {operator.upper()} ({', '.join(_sql_literal(v) for v in values)})"
+    return f"{column} {operator} {_sql_literal(value)}"
+
+
+def _spark_predicates(where):
+    condition = F.lit(True)
+    for predicate in where:
+        column, operator = predicate[0], predicate[1].lower()
+        value = predicate[2] if len(predicate) > 2 else None
+        if operator not in PREDICATE_OPERATORS:
+            raise ValueError(f"Unsupported operator: {operator!r}")
+        expression = {
+            "=": lambda c: c == value,
+            "!=": lambda c: c != value,
+            "<": lambda c: c < value,
+            "<=": lambda c: c <= value,
+            ">": lambda c: c > value,
+            ">=": lambda c: c >= value,
+            "in": lambda c: c.isin(list(value)) if list(value) else F.lit(False),
+            "not in": lambda c: ~c.isin(list(value)) if list(value) else F.lit(True),
+            "is null": lambda c: c.isNull(),
+            "is not null": lambda c: c.isNotNull(),
+        }[operator](F.col(column))
+        condition = condition & expression
+    return condition
+
+# O 'pool' de sessões guarda, para cada chave (warehouse, database, schema), as sessões já autenticadas (com a ligação JDBC aberta por 'handshake') que não estão a ser utilizadas.
+# 'checkout' devolve uma sessão inativa da mesma chave (sem novo 'handshake') ou abre uma nova, até ao limite 'size' por chave; acima do limite, espera que uma sessão seja devolvida.
+# 'checkin' devolve a sessão ao 'pool'. Sessões de chamadas que falharam são fechadas e descartadas, para que a chamada seguinte volte a autenticar.
+# 'evict_idle' fecha as sessões inativas há mais de 'idle_timeout' segundos e 'close' fecha todas as sessões inativas.
+# Cada chamada fica registada em 'metrics' (tempo de 'checkout', reutilização ou não da sessão e duração da chamada); 'stats()' resume essas métricas por chave.
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class SnowflakeSession:
+    def __init__(self, key, options, connection):
+        self.key = key
+        self.options = options
+        self.connection = connection
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.uses = 0
+
+
+class SnowflakeSessionPool:
+    def __init__(self, handshake, size=4, idle_timeout=600):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.handshake = handshake
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.metrics = []
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Condition()
+
+    def checkout(self, key, options):
+        start_time = time.time()
+        with self._lock:
+            self.evict_idle()
+            while not self._idle.get(key) and self._open.get(key, 0) >= self.size:
+                self._lock.wait()
+            if self._idle.get(key):
+                session = self._idle[key].pop()
+            else:
+                session = None
+                self._open[key] = self._open.get(key, 0) + 1
+        reused = session is not None
+        if not reused:
+            try:
+                connection = self.handshake(options)
+            except Exception:
+                self._discard(key)
+                raise
+            session = SnowflakeSession(key, options, connection)
+        session.uses += 1
+        return session, reused, time.time() - start_time
+
+    def checkin(self, session):
+        with self._lock:
+            session.last_used = time.time()
+            self._idle.setdefault(session.key, []).append(session)
+            self._lock.notify()
+
+    def _discard(self, key, session=None):
+        if session is not None:
+            _close_quietly(session.connection)
+        with self._lock:
+            self._open[key] -= 1
+            self._lock.notify()
+
+    def evict_idle(self):
+        evicted = 0
+        with self._lock:
+            now = time.time()
+            for key, sessions in self._idle.items():
+                alive = [s for s in sessions if now - s.last_used < self.idle_timeout]
+                for session in sessions:
+                    if session not in alive:
+                        _close_quietly(session.connection)
+                evicted += len(sessions) - len(alive)
+                self._open[key] -= len(sessions) - len(alive)
+                self._idle[key] = alive
+        return evicted
+
+    @contextmanager
+    def session(self, key, options, call):
+        session, reused, checkout_time = self.checkout(key, options)
+        start_time = time.time()
+        failed = False
+        try:
+            yield session
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if failed:
+                self._discard(key, session)
+            else:
+                self.checkin(session)
+            with self._lock:
+                self.metrics.append(
+                    {
+                        "call": call,
+                        "key": key,
+                        "reused": reused,
+                        "checkout_seconds": round(checkout_time, 4),
+                        "call_seconds": round(time.time() - start_time, 4),
+                        "failed": failed,
+                    }
+                )
+
+    def close(self):
+        with self._lock:
+            for key, sessions in self._idle.items():
+                for session in sessions:
+                    _close_quietly(session.connection)
+                self._open[key] -= len(sessions)
+                self._idle[key] = []
+
+    def stats(self):
+        with self._lock:
+            metrics = list(self.metrics)
+        if not metrics:
+            return pd.DataFrame()
+        stats = pd.DataFrame(metrics).assign(key=lambda d: d["key"].astype(str))
+        return stats.groupby("key").agg(
+            calls=("call", "count"),
+            handshakes=("reused", lambda r: int((~r).sum())),
+            reused=("reused", "sum"),
+            failed=("failed", "sum"),
+            checkout_seconds_mean=("checkout_seconds", "mean"),
+            checkout_seconds_max=("checkout_seconds", "max"),
+        )
+
+
+# A cache de 'staging' guarda uma cópia local, colunar e comprimida (Parquet), de cada tabela, particionada pelo ano da primeira coluna de data disponível ('START' ou 'DATE').
+# O ficheiro '_manifest.json' guarda, por tabela, a impressão digital da origem no momento da escrita. 'is_fresh' compara essa impressão digital com a atual.
+# O manifesto é gravado num ficheiro temporário e depois substituído ('os.replace'), pelo que uma escrita interrompida nunca deixa um manifesto incompleto.
+# A invalidação é explícita: 'invalidate(key)' apaga a cópia de uma tabela e 'invalidate()' apaga todas. Uma cópia cuja origem mudou é simplesmente reescrita na leitura seguinte.
+# Os caminhos '/dbfs/...' são utilizados pelo Python (manifesto) e convertidos para 'dbfs:/...' nas leituras/escritas do Spark.
+
+def _spark_path(path):
+    if path.startswith("/dbfs/"):
+        return "dbfs:/" + path[len("/dbfs/"):]
+    return path
+
+
+class StagingCache:
+    def __init__(
+        self,
+        root="/dbfs/FileStore/staging",
+        partition_columns=("START", "DATE"),
+        compression="snappy",
+    ):
+        self.root = root
+        self.partition_columns = partition_columns
+        self.compression = compression
+        self._manifest_path = os.path.join(root, "_manifest.json")
+        self._lock = threading.Lock()
+
+    def path_for(self, key):
+        return os.path.join(self.root, key.replace(".", "_").lower())
+
+    def manifest(self):
+        if not os.path.exists(self._manifest_path):
+            return {}
+        with open(self._manifest_path) as f:
+            return json.load(f)
+
+    def _update_manifest(self, update):
+        with self._lock:
+            manifest = self.manifest()
+            update(manifest)
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._manifest_path + ".tmp", "w") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(self._manifest_path + ".tmp", self._manifest_path)
+
+    def is_fresh(self, key, fingerprint):
+        entry = self.manifest().get(key)
+        return (
+            entry is not None
+            and fingerprint is not None
+            and entry["fingerprint"] == fingerprint
+        )
+
+    def write(self, df, key, fingerprint=None):
+        partition_column = next(
+            (column for column in self.partition_columns if column in df.columns), None
+        )
+        writer = df
+        if partition_column is not None:
+            writer = writer.withColumn("YEAR_PARTITION", F.year(partition_column))
+        writer = writer.write.mode("overwrite").option("compression", self.compression)
+        if partition_column is not None:
+            writer = writer.partitionBy("YEAR_PARTITION")
+        writer.parquet(_spark_path(self.path_for(key)))
+
+        def update(manifest):
+            manifest[key] = {
+                "fingerprint": fingerprint,
+                "partition_column": partition_column,
+                "written_at": time.time(),
+            }
+
+        self._update_manifest(update)
+
+    def set_fingerprint(self, key, fingerprint):
+        def update(manifest):
+            manifest[key]["fingerprint"] = fingerprint
+
+        self._update_manifest(update)
+
+    def read(self, key):
+        return spark.read.parquet(_spark_path(self.path_for(key))).drop(
+            "YEAR_PARTITION"
+        )
+
+    def invalidate(self, key=None):
+        def update(manifest):
+            for staged_key in [key] if key is not None else list(manifest):
+                manifest.pop(staged_key, None)
+                shutil.rmtree(self.path_for(staged_key), ignore_errors=True)
+
+        self._update_manifest(update)
+
+
+# A pasta de 'staging' da escrita em massa ('write_table(..., bulk=True)') guarda os ficheiros de uma tabela antes do envio para o SF.
+# O número de ficheiros é calculado a partir do tamanho estimado do DataFrame (estatísticas do plano do Spark) e do tamanho alvo por ficheiro ('target_file_mb', antes da compressão), em vez das partições por defeito: as tabelas pequenas dão um único ficheiro e as grandes são divididas em ficheiros de tamanho semelhante.
+# Os ficheiros são gravados em paralelo pelo Spark (um por partição), em Parquet ('snappy') ou CSV comprimido ('gzip'), e enviados com até 'max_workers' 'uploads' em simultâneo.
+# 'copy_options' devolve o formato do ficheiro para o 'COPY INTO' do SF. As datas são gravadas no Parquet como 'TIMESTAMP_MICROS', que o SF lê diretamente.
+# O Spark ignora essa opção quando indicada no próprio 'writer' (prevalece a configuração da sessão), pelo que 'spark.sql.parquet.outputTimestampType' é alterada apenas durante as escritas da 'staging' e reposta no fim da última escrita em curso.
+# No CSV as aspas dentro dos campos são duplicadas ('escape' = '"'), tal como o SF espera com 'FIELD_OPTIONALLY_ENCLOSED_BY', e as barras invertidas fora de aspas não são tratadas como 'escape' ('ESCAPE_UNENCLOSED_FIELD = NONE').
+# 'read_uploaded' relê os ficheiros enviados com o Spark, apenas para as fontes locais ('jdbc') sem 'COPY INTO'; no CSV o Spark lê os textos vazios ('""') como nulos, ao contrário do SF.
+
+class BulkStage:
+    FILE_SUFFIXES = {"parquet": ".parquet", "csv": ".csv.gz"}
+    TIMESTAMP_CONF = "spark.sql.parquet.outputTimestampType"
+    _conf_lock = threading.Lock()
+    _conf_writers = 0
+    _conf_previous = None
+
+    def __init__(
+        self,
+        root="/dbfs/FileStore/bulk_stage",
+        file_format="parquet",
+        target_file_mb=128,
+        max_workers=4,
+    ):
+        if file_format not in self.FILE_SUFFIXES:
+            raise ValueError(f"Unsupported bulk file format: {file_format!r}")
+        self.root = root
+        self.file_format = file_format
+        self.target_file_mb = target_file_mb
+        self.max_workers = max_workers
+
+    def path_for(self, table):
+        return os.path.join(self.root, table.lower())
+
+    def uploaded_path_for(self, table):
+        return os.path.join(self.root, "_uploaded", table.lower())
+
+    def file_count(self, df):
+        size = int(str(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes()))
+        # Sem estatísticas o Spark devolve o maior 'Long' possível; nesse caso as partições atuais são mantidas.
+        if size >= 2**63 - 1:
+            return df.rdd.getNumPartitions()
+        return max(1, -(-size // (self.target_file_mb * 1024 * 1024)))
+
+    def write(self, df, table):
+        path = self.path_for(table)
+        writer = df.repartition(self.file_count(df)).write.mode("overwrite")
+        if self.file_format == "parquet":
+            writer = writer.option("compression", "snappy")
+            with self._micros_timestamps():
+                writer.format(self.file_format).save(_spark_path(path))
+        else:
+            writer = (
+                writer.option("compression", "gzip")
+                .option("header", "true")
+                .option("escape", '"')
+            )
+            writer.format(self.file_format).save(_spark_path(path))
+        return sorted(
+            os.path.join(path, file)
+            for file in os.listdir(path)
+            if file.endswith(self.FILE_SUFFIXES[self.file_format])
+        )
+
+    @classmethod
+    @contextmanager
+    def _micros_timestamps(cls):
+        with cls._conf_lock:
+            if cls._conf_writers == 0:
+                cls._conf_previous = spark.conf.get(cls.TIMESTAMP_CONF, None)
+                spark.conf.set(cls.TIMESTAMP_CONF, "TIMESTAMP_MICROS")
+            cls._conf_writers += 1
+        try:
+            yield
+        finally:
+            with cls._conf_lock:
+                cls._conf_writers -= 1
+                if cls._conf_writers == 0:
+                    if cls._conf_previous is None:
+                        spark.conf.unset(cls.TIMESTAMP_CONF)
+                    else:
+                        spark.conf.set(cls.TIMESTAMP_CONF, cls._conf_previous)
+
+    def copy_options(self):
+        if self.file_format == "parquet":
+            return "FILE_FORMAT = (TYPE = PARQUET) MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE"
+        return (
+            "FILE_FORMAT = (TYPE = CSV COMPRESSION = GZIP SKIP_HEADER = 1 "
+            "FIELD_OPTIONALLY_ENCLOSED_BY = '\"' ESCAPE_UNENCLOSED_FIELD = NONE)"
+        )
+
+    def read_uploaded(self, schema, table, paths=None):
+        paths = paths or [self.uploaded_path_for(table)]
+        return (
+            spark.read.format(self.file_format)
+            .schema(schema)
+            .option("header", "true")
+            .option("escape", '"')
+            .load([_spark_path(path) for path in paths])
+        )
+
+    def clear(self, table):
+        shutil.rmtree(self.path_for(table), ignore_errors=True)
+        shutil.rmtree(self.uploaded_path_for(table), ignore_errors=True)
+
+
+# 'RetryPolicy' repete uma chamada que falhou até 'retries' vezes, esperando 'backoff' * 'factor' ^ tentativa segundos entre tentativas (no máximo 'max_backoff').
+# Apenas as falhas transitórias são repetidas: as exceções de 'retry_on' (por defeito falhas de rede e 'timeouts') e os erros do Java cuja causa é uma das classes de 'TRANSIENT_JAVA_ERRORS' ou um 'SQLException' de ligação ('SQLState' 08xxx). Os restantes erros (tabela já existente, SQL inválido, permissões) e a última falha são propagados de imediato, sem 'backoff'.
+# 'WriteCheckpoints' guarda em JSON, por tabela, as partes já escritas (e, na escrita em massa, os ficheiros enviados por cada parte), o número de repetições e o estado da escrita ('em curso', 'falhou' ou 'completo').
+# A cópia local das linhas divididas por parte fica em 'chunk_root' ('write_chunks' ao lado do ficheiro JSON) até a tabela estar completa. Um registo de uma versão anterior, sem essa cópia, volta a ser escrito do início.
+# Uma tabela que falhou é retomada. Uma tabela 'completo' (ou com outro número de partes) volta a ser escrita do início na chamada seguinte, exceto no modo 'errorifexists', em que uma tabela 'completo' já está escrita e não é alterada. 'summary()' resume o estado de todas as tabelas.
+
+
+class RetryPolicy:
+    TRANSIENT_JAVA_ERRORS = (
+        "java.sql.SQLTransientException",
+        "java.sql.SQLRecoverableException",
+        "java.net.SocketException",
+        "java.net.SocketTimeoutException",
+    )
+
+    def __init__(
+        self,
+        retries=3,
+        backoff=1.0,
+        factor=2.0,
+        max_backoff=60.0,
+        retry_on=(ConnectionError, TimeoutError),
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+
+    def delay(self, attempt):
+        return min(self.max_backoff, self.backoff * self.factor**attempt)
+
+    def is_transient(self, error):
+        if isinstance(error, self.retry_on):
+            return True
+        java_error = getattr(error, "java_exception", None)
+        while java_error is not None:
+            for name in self.TRANSIENT_JAVA_ERRORS:
+                if spark._jvm.java.lang.Class.forName(name).isInstance(java_error):
+                    return True
+            if spark._jvm.java.lang.Class.forName("java.sql.SQLException").isInstance(
+                java_error
+            ) and str(java_error.getSQLState() or "").startswith("08"):
+                return True
+            java_error = java_error.getCause()
+        return False
+
+    def run(self, call, on_retry=None):
+        for attempt in range(self.retries + 1):
+            try:
+                return call()
+            except Exception as e:
+                if attempt == self.retries or not self.is_transient(e):
+                    raise
+                if on_retry is not None:
+                    on_retry(attempt + 1, e)
+                time.sleep(self.delay(attempt))
+
+
+class WriteCheckpoints:
+    def __init__(self, path="/dbfs/FileStore/write_checkpoints.json", chunk_root=None):
+        self.path = path
+        self.chunk_root = chunk_root or os.path.join(os.path.dirname(path), "write_chunks")
+        self._lock = threading.Lock()
+
+    def chunk_path(self, key):
+        return os.path.join(self.chunk_root, key.replace(".", "_").lower())
+
+    def state(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _update(self, update):
+        with self._lock:
+            state = self.state()
+            update(state)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(state, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+            return state
+
+    def start(self, key, chunks):
+        def update(state):
+            entry = state.get(key)
+            if (
+                entry is None
+                or entry["status"] == "completo"
+                or entry["chunks"] != chunks
+                or "staged" not in entry
+            ):
+                state[key] = {
+                    "chunks": chunks,
+                    "done": [],
+                    "files": {},
+                    "staged": False,
+                    "created": False,
+                    "copied": False,
+                    "baseline_rows": 0,
+                    "retries": 0,
+                    "runs": 0,
+                    "error": None,
+                }
+            state[key]["status"] = "em curso"
+            state[key]["runs"] += 1
+
+        return self._update(update)[key]
+
+    def update(self, key, **changes):
+        self._update(lambda state: state[key].update(changes))
+
+    def mark_done(self, key, chunk, files=None):
+        def update(state):
+            state[key]["done"].append(chunk)
+            if files is not None:
+                state[key]["files"][str(chunk)] = files
+
+        self._update(update)
+
+    def record_retry(self, key, error):
+        def update(state):
+            state[key]["retries"] += 1
+            state[key]["error"] = str(error)
+
+        self._update(update)
+
+    def reset(self, key=None):
+        def update(state):
+            for table in [key] if key is not None else list(state):
+                state.pop(table, None)
+                shutil.rmtree(self.chunk_path(table), ignore_errors=True)
+
+        self._update(update)
+
+    def summary(self):
+        return pd.DataFrame(
+            [
+                {
+                    "Tabela": key,
+                    "Estado": entry["status"],
+                    "Partes escritas": len(entry["done"]),
+                    "Partes": entry["chunks"],
+                    "Execuções": entry["runs"],
+                    "Repetições": entry["retries"],
+                    "Erro": entry["error"],
+                }
+                for key, entry in self.state().items()
+            ]
+        )
+
+
+# 'Catalog' dá acesso às tabelas por atributo ('catalog.patients') ou por chave ('catalog["patients"]'), aceitando também o nome com o prefixo 'df_' ('catalog.df_patients').
+# Cada tabela é resolvida ('loader(nome)') apenas no primeiro acesso; o DataFrame e o seu 'schema' ficam guardados, pelo que os acessos seguintes não voltam a preparar a leitura. As tabelas que nunca são usadas nunca são lidas.
+# 'preload' resolve várias tabelas de uma vez, em paralelo; com 'wait=False' a resolução continua em segundo plano e um acesso a uma tabela ainda em resolução espera apenas por essa tabela.
+# 'load_times' guarda o tempo de resolução de cada tabela e 'loaded()' as tabelas já resolvidas.
+
+class Catalog:
+    def __init__(self, loader, names=(), max_workers=4):
+        self._loader = loader
+        self.names = tuple(names)
+        self._tables = {}
+        self._schemas = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.load_times = {}
+
+    def _name(self, name):
+        if name not in self.names and name.startswith("df_"):
+            name = name[len("df_"):]
+        if self.names and name not in self.names:
+            raise KeyError(name)
+        return name
+
+    def __getitem__(self, name):
+        name = self._name(name)
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._tables:
+                start_time = time.time()
+                df = self._loader(name)
+                self._schemas[name] = df.schema
+                self._tables[name] = df
+                self.load_times[name] = round(time.time() - start_time, 4)
+        return self._tables[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, name):
+        try:
+            self._name(name)
+        except KeyError:
+            return False
+        return True
+
+    def schema(self, name):
+        self[name]
+        return self._schemas[self._name(name)]
+
+    def set(self, name, df):
+        name = self._name(name)
+        self._tables[name] = df
+        self._schemas[name] = df.schema
+
+    def preload(self, names, wait=True):
+        futures = {name: self._executor.submit(self.__getitem__, name) for name in names}
+        if wait:
+            for future in futures.values():
+                future.result()
+        return futures
+
+    def loaded(self):
+        return list(self._tables)
+
+    def invalidate(self, name=None):
+        for table in [self._name(name)] if name is not None else list(self._tables):
+            self._tables.pop(table, None)
+            self._schemas.pop(table, None)
+            self.load_times.pop(table, None)
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -135,8 +1251,11 @@ class DatabricksSnowflakeConnection:
 # COMMAND ----------
 
 # Objeto 'francisco' permite estabelecer e verificar a ligação entre o Databricks (DB) e o SF.
-# Na eventualidade de ainda não terem sido criados novos 'databases', 'schemas' e/ou 'tabelas' no SF, a definição da função de conexão será estabelecida por intermédio da leitura de uma das tabelas de amostragem previamente forneceidas pelo SF. 
+# A criação do objeto é imediata: nenhuma tabela é lida, apenas as credenciais e as opções de conexão são validadas.
+# A verificação da conexão é feita uma única vez, no fim da célula ('francisco.connect()'), com a ligação ao schema de uma das tabelas de amostragem previamente forneceidas pelo SF.
 # Se a conexão for bem-sucedida, uma mensagem indicando o sucesso é impressa. Se ocorrer uma exceção (erro), uma mensagem de falha é impressa.
+# As leituras com 'prefer_cache=True' são servidas pela cópia local em Parquet ('/dbfs/FileStore/staging') enquanto a tabela não for alterada no SF.
+# Para forçar uma nova leitura a partir do SF: 'francisco.stage_cache.invalidate()'.
 # Mensagem de sucesso expectável: "Connection between Databricks and Snowflake executed successfully".
 
 francisco = DatabricksSnowflakeConnection(
@@ -147,10 +1266,779 @@ francisco = DatabricksSnowflakeConnection(
     db="SNOWFLAKE_SAMPLE_DATA",
     schema="TPCH_SF10",
     table="CUSTOMER",
+    stage_cache=StagingCache("/dbfs/FileStore/staging"),
+)
+francisco.connect()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Funções auxiliares da EDA
+
+# COMMAND ----------
+
+# Contagem de linhas partilhada ('row_counts').
+# Cada '.count()' volta a executar toda a linhagem do DataFrame (leitura + transformações). O objeto 'row_counts' guarda a contagem de cada DataFrame já contado, identificado pelo seu plano lógico ('semanticHash' / 'sameSemantics').
+# Uma segunda contagem de um DataFrame com o mesmo plano é servida da memória, sem nenhum novo 'job' Spark.
+
+class RowCounter:
+    def __init__(self):
+        self._counts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, df):
+        entries = self._counts.setdefault(df.semanticHash(), [])
+        for counted_df, rows in entries:
+            if counted_df.sameSemantics(df):
+                self.hits += 1
+                return rows
+        self.misses += 1
+        rows = df.count()
+        entries.append((df, rows))
+        return rows
+
+
+row_counts = RowCounter()
+
+# COMMAND ----------
+
+# Estatísticas descritivas numa única passagem ('describe_numeric').
+# Para cada coluna de 'cols' são calculados o número de valores, mínimo, máximo, média, desvio padrão e os quantis pedidos ('quantiles'), todos numa única agregação (um único 'job' Spark).
+# Os quantis são obtidos com 'percentile_approx', que utiliza um 'sketch' (Greenwald-Khanna) calculado por partição e depois combinado, com erro relativo 'rel_error'.
+# O resultado é uma tabela 'pandas' com uma linha por coluna.
+
+def describe_numeric(df, cols, quantiles=(0.5,), rel_error=0.0001):
+    accuracy = max(1, int(1 / rel_error))
+    aggregations = []
+    for c in cols:
+        aggregations += [
+            F.count(F.col(c)).alias(f"{c}__count"),
+            F.min(F.col(c)).alias(f"{c}__min"),
+            F.max(F.col(c)).alias(f"{c}__max"),
+            F.avg(F.col(c)).alias(f"{c}__mean"),
+            F.stddev(F.col(c)).alias(f"{c}__stddev"),
+            F.percentile_approx(F.col(c), list(quantiles), accuracy).alias(
+                f"{c}__quantiles"
+            ),
+        ]
+    row = df.agg(*aggregations).collect()[0]
+    return pd.DataFrame(
+        [
+            {
+                "column": c,
+                "count": row[f"{c}__count"],
+                "min": row[f"{c}__min"],
+                "max": row[f"{c}__max"],
+                "mean": row[f"{c}__mean"],
+                "stddev": row[f"{c}__stddev"],
+                **{
+                    f"q{q}": value
+                    for q, value in zip(quantiles, row[f"{c}__quantiles"] or [])
+                },
+            }
+            for c in cols
+        ]
+    ).set_index("column")
+
+
+# COMMAND ----------
+
+# Distribuição de variáveis categóricas numa única passagem ('categorical_distribution').
+# Cada linha de 'df' é transformada num conjunto de pares (coluna, valor), um por cada coluna de 'cols', e a contagem é feita com um único 'groupBy' sobre esses pares.
+# Desta forma as contagens, percentagens sobre o total, 'top-k' e 'bottom-k' de todas as colunas são obtidas com uma única leitura de 'df', em vez de um 'groupBy' (e um 'count()' do total) por coluna.
+# O resultado (pequeno) é devolvido como tabela 'pandas' no formato 'tidy': uma linha por (coluna, valor).
+
+def categorical_distribution(df, cols, top_k=1, bottom_k=1):
+    pairs = df.select(
+        F.explode(
+            F.array(
+                *[
+                    F.struct(
+                        F.lit(c).alias("COLUMN"), F.col(c).cast("string").alias("VALUE")
+                    )
+                    for c in cols
+                ]
+            )
+        ).alias("PAIR")
+    ).select("PAIR.*")
+    by_column = Window.partitionBy("COLUMN")
+    distribution = (
+        pairs.groupBy("COLUMN", "VALUE")
+        .count()
+        .withColumn("TOTAL", F.sum("count").over(by_column))
+        .withColumn("PERCENTAGE", F.col("count") / F.col("TOTAL") * 100)
+        .withColumn(
+            "RANK_DESC",
+            F.row_number().over(by_column.orderBy(F.desc("count"), "VALUE")),
+        )
+        .withColumn(
+            "RANK_ASC", F.row_number().over(by_column.orderBy(F.asc("count"), "VALUE"))
+        )
+        .withColumn("TOP_K", F.col("RANK_DESC") <= top_k)
+        .withColumn("BOTTOM_K", F.col("RANK_ASC") <= bottom_k)
+        .toPandas()
+    )
+    return distribution.sort_values(["COLUMN", "RANK_DESC"]).reset_index(drop=True)
+
+
+def distribution_of(distribution, column, label, decimals):
+    # Extrai de 'categorical_distribution' a tabela de uma coluna, no formato das perguntas (valor, contagem e percentagem).
+    table = distribution[distribution["COLUMN"] == column]
+    return pd.DataFrame(
+        {
+            column: table["VALUE"],
+            "count": table["count"],
+            label: table["PERCENTAGE"].round(decimals),
+        }
+    ).reset_index(drop=True)
+
+
+# COMMAND ----------
+
+# Medição do número de 'jobs' Spark, do tempo de execução e dos 'bytes' escritos em 'shuffle' de uma função ('measure_jobs').
+# Os 'jobs' lançados pela função ficam agrupados num 'job group' próprio, que é depois consultado no 'statusTracker'.
+# Os 'bytes' de 'shuffle' de cada 'stage' são lidos do 'status store' interno do Spark (o mesmo que alimenta a 'Spark UI'); se essa API não estiver disponível o valor fica nulo.
+
+def shuffle_write_bytes(job_ids):
+    sc = spark.sparkContext
+    try:
+        store = sc._jsc.sc().statusStore()
+        total = 0
+        for job_id in job_ids:
+            stage_ids = store.job(job_id).stageIds().iterator()
+            while stage_ids.hasNext():
+                attempts = store.stageData(
+                    stage_ids.next(),
+                    False,
+                    sc._jvm.java.util.ArrayList(),
+                    False,
+                    sc._gateway.new_array(sc._jvm.double, 0),
+                ).iterator()
+                while attempts.hasNext():
+                    total += attempts.next().shuffleWriteBytes()
+        return total
+    except Exception:
+        return None
+
+
+def measure_jobs(function, label):
+    group = f"measure_{time.time_ns()}"
+    spark.sparkContext.setJobGroup(group, label)
+    start_time = time.time()
+    try:
+        result = function()
+    finally:
+        spark.sparkContext.setLocalProperty("spark.jobGroup.id", None)
+    seconds = time.time() - start_time
+    job_ids = spark.sparkContext.statusTracker().getJobIdsForGroup(group)
+    return result, {
+        "Medição": label,
+        "Jobs Spark": len(job_ids),
+        "Tempo (segundos)": round(seconds, 2),
+        "Shuffle (bytes)": shuffle_write_bytes(job_ids),
+    }
+
+# COMMAND ----------
+
+# Junção de uma tabela de factos com uma dimensão ('dimension_join').
+# O tamanho da dimensão é estimado a partir das estatísticas do plano lógico otimizado ('sizeInBytes'), sem executar nenhum 'job' Spark.
+# Quando a fonte não fornece estatísticas (por exemplo leituras do SF ou DataFrames criados em memória, cujo tamanho estimado é o máximo possível), é utilizado o número de linhas da dimensão ('row_counts', 'broadcast_rows').
+# Se a dimensão for pequena ('broadcast_threshold'), é enviada para todos os 'executors' ('broadcast'), e a tabela de factos não é redistribuída ('shuffle').
+# Caso contrário a junção é feita por 'shuffle' ('SortMergeJoin'), e é feita uma amostra ('sample_fraction') das chaves da tabela de factos para detetar chaves muito frequentes ('skew_factor' vezes acima da média).
+# As linhas dessas chaves são distribuídas aleatoriamente por 'salt_buckets' partições ('salting'), e as linhas correspondentes da dimensão são replicadas uma vez por partição, para que nenhuma tarefa fique com todas as linhas de um mesmo doente.
+# O 'salting' apenas é válido para junções 'inner' e 'left', que são as utilizadas na EDA.
+
+UNKNOWN_SIZE = 2**63 - 1
+
+
+def dimension_size(df):
+    return int(str(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes()))
+
+
+def is_small_dimension(df, broadcast_threshold, broadcast_rows):
+    size = dimension_size(df)
+    if size < UNKNOWN_SIZE:
+        return size <= broadcast_threshold
+    return broadcast_threshold >= 0 and row_counts.count(df) <= broadcast_rows
+
+
+def hot_keys(df, key, sample_fraction=0.01, skew_factor=20.0, seed=42):
+    sample = df.sample(fraction=sample_fraction, seed=seed).groupBy(key).count()
+    mean_count = sample.agg(F.avg("count")).collect()[0][0]
+    if mean_count is None:
+        return []
+    return [
+        row[key]
+        for row in sample.filter(F.col("count") > skew_factor * mean_count)
+        .select(key)
+        .collect()
+    ]
+
+
+def dimension_join(
+    fact,
+    dimension,
+    key,
+    how="inner",
+    broadcast_threshold=64 * 1024 * 1024,
+    broadcast_rows=1000000,
+    salt_buckets=16,
+    sample_fraction=0.01,
+    skew_factor=20.0,
+):
+    if how not in ("inner", "left"):
+        raise ValueError(f"Unsupported join type for dimension_join: {how}")
+    if is_small_dimension(dimension, broadcast_threshold, broadcast_rows):
+        return fact.join(F.broadcast(dimension), on=key, how=how)
+    keys = hot_keys(fact, key, sample_fraction, skew_factor) if salt_buckets > 1 else []
+    if not keys:
+        return fact.join(dimension.hint("merge"), on=key, how=how)
+    is_hot = F.col(key).isin(keys)
+    salted_fact = fact.withColumn(
+        "SALT",
+        F.when(is_hot, F.floor(F.rand() * salt_buckets)).otherwise(F.lit(0)).cast("int"),
+    )
+    salted_dimension = dimension.withColumn(
+        "SALT",
+        F.explode(
+            F.when(is_hot, F.sequence(F.lit(0), F.lit(salt_buckets - 1))).otherwise(
+                F.array(F.lit(0))
+            )
+        ),
+    )
+    return salted_fact.join(
+        salted_dimension.hint("merge"), on=[key, "SALT"], how=how
+    ).drop("SALT")
+
+
+def join_strategy(df):
+    # Estratégia de junção escolhida pelo Spark, lida do plano físico (o mesmo que é mostrado por '.explain()').
+    plan = df._jdf.queryExecution().executedPlan().toString()
+    for strategy in (
+        "BroadcastHashJoin",
+        "SortMergeJoin",
+        "ShuffledHashJoin",
+        "BroadcastNestedLoopJoin",
+    ):
+        if strategy in plan:
+            return strategy
+    return None
+
+# COMMAND ----------
+
+# Junção 'as-of' (valor mais recente no tempo, 'asof_join').
+# Cada linha de 'left' recebe os valores da linha de 'right' do mesmo 'by' (por exemplo o mesmo doente) com a data 'on' mais próxima, igual ou anterior à sua.
+# As duas tabelas são unidas ('unionByName') e ordenadas por 'by' e 'on' dentro de cada partição; o último valor não nulo de 'right' até cada linha é obtido com uma 'Window' ('last' com 'ignorenulls').
+# Em caso de datas iguais, as linhas de 'right' são ordenadas antes das de 'left', para que sejam consideradas.
+# O resultado tem exatamente uma linha por linha de 'left', em vez de todas as combinações de 'left' x 'right' do mesmo 'by' (produto cartesiano).
+# Com 'how="inner"' as linhas de 'left' sem nenhuma linha de 'right' anterior são removidas; com 'how="left"' ficam com valores nulos.
+
+def asof_join(left, right, by, on, how="inner"):
+    if how not in ("inner", "left"):
+        raise ValueError(f"Unsupported join type for asof_join: {how}")
+    value_columns = [c for c in right.columns if c not in (by, on)]
+    overlap = [c for c in value_columns if c in left.columns]
+    if overlap:
+        raise ValueError(f"Columns present on both sides of asof_join: {overlap}")
+    rows = left.withColumn("_ASOF_SIDE", F.lit(1)).unionByName(
+        right.withColumn("_ASOF_SIDE", F.lit(0)), allowMissingColumns=True
+    )
+    window = (
+        Window.partitionBy(by)
+        .orderBy(on, "_ASOF_SIDE")
+        .rowsBetween(Window.unboundedPreceding, Window.currentRow)
+    )
+    joined = rows.select(
+        *[c for c in rows.columns if c not in value_columns],
+        *[F.last(c, ignorenulls=True).over(window).alias(c) for c in value_columns],
+    )
+    joined = joined.filter(F.col("_ASOF_SIDE") == 1).drop("_ASOF_SIDE")
+    if how == "inner":
+        joined = joined.na.drop(how="all", subset=value_columns)
+    return joined.select(*left.columns, *value_columns)
+
+# COMMAND ----------
+
+# Episódios de cada condição ('condition_episodes').
+# Um mesmo doente pode ter várias linhas da mesma condição ('CODE'), com intervalos ('START' - 'STOP') sobrepostos ou consecutivos. Essas linhas são juntas num único episódio, para que a duração de uma doença não seja contada várias vezes.
+# A data final de cada linha é 'STOP'; quando 'STOP' é nulo (condição em aberto) é utilizada a data de morte ('DEATHDATE') ou, para doentes vivos, 'reference_date' ('None' mantém a condição em aberto, com duração nula). Para doentes mortos a data final nunca é posterior à data da morte.
+# As linhas de cada (doente, condição) são ordenadas por 'START' numa única 'Window': uma linha inicia um novo episódio quando começa mais de 'gap_days' dias depois da maior data final das linhas anteriores; a soma acumulada desses inícios numera os episódios ('EPISODE').
+# O resultado tem uma linha por episódio, com a duração em dias ('DURATION_DAYS') e em anos completos ('DURATION_YEARS') como inteiros, e a indicação de doença crónica ('CHRONIC': mais de 'chronic_years' anos completos, a mesma regra da pergunta 11).
+# A condição é identificada pela coluna 'code' (por defeito 'CODE'; na EDA a chave inteira 'CODE_KEY', ver 'code_dimension'); a descrição é acrescentada apenas na visualização.
+
+OPEN_END = "9999-12-31"
+
+
+def condition_episodes(df, reference_date=None, gap_days=1, chronic_years=1, code="CODE"):
+    end = F.coalesce(
+        F.col("STOP"),
+        F.col("DEATHDATE"),
+        F.to_date(F.lit(reference_date)) if reference_date else F.lit(None).cast(DateType()),
+    )
+    end = F.when(
+        F.col("DEATHDATE").isNotNull(), F.least(end, F.col("DEATHDATE"))
+    ).otherwise(end)
+    rows = df.select(
+        "ID",
+        code,
+        F.col("START").cast(DateType()).alias("START"),
+        F.coalesce(end.cast(DateType()), F.to_date(F.lit(OPEN_END))).alias("END"),
+    )
+    window = Window.partitionBy("ID", code).orderBy("START", "END")
+    previous_end = F.max("END").over(
+        window.rowsBetween(Window.unboundedPreceding, -1)
+    )
+    rows = rows.withColumn(
+        "NEW_EPISODE",
+        F.when(
+            previous_end.isNull() | (F.col("START") > F.date_add(previous_end, gap_days)),
+            1,
+        ).otherwise(0),
+    ).withColumn(
+        "EPISODE",
+        F.sum("NEW_EPISODE")
+        .over(window.rowsBetween(Window.unboundedPreceding, Window.currentRow))
+        .cast(IntegerType()),
+    )
+    episodes = rows.groupBy("ID", code, "EPISODE").agg(
+        F.min("START").alias("START"),
+        F.max("END").alias("STOP"),
+        F.count(F.lit(1)).cast(IntegerType()).alias("N_ROWS"),
+    )
+    stop = F.when(F.col("STOP") != F.to_date(F.lit(OPEN_END)), F.col("STOP"))
+    duration_days = F.datediff(stop, F.col("START")).cast(IntegerType())
+    duration_years = F.floor(duration_days / 365.25).cast(IntegerType())
+    return episodes.select(
+        "ID",
+        code,
+        "EPISODE",
+        "START",
+        stop.alias("STOP"),
+        "N_ROWS",
+        duration_days.alias("DURATION_DAYS"),
+        duration_years.alias("DURATION_YEARS"),
+        (duration_years > chronic_years).alias("CHRONIC"),
+    )
+
+
+def with_duration_label(df, days_column, years_column, label_column):
+    # Texto da duração, apenas para visualização: o número de anos, ou 'less than 1 year' até 365 dias. As colunas 'days_column' e 'years_column' continuam numéricas ('int').
+    return df.withColumn(
+        label_column,
+        F.when(
+            F.col(days_column) > 365, F.col(years_column).cast("string")
+        ).otherwise(F.lit("less than 1 year")),
+    )
+
+# COMMAND ----------
+
+# Dimensão dos códigos das condições ('code_dimension').
+# Cada código ('CODE') recebe uma chave inteira ('CODE_KEY', numeração densa dos códigos por ordem crescente) e uma única descrição canónica (a descrição mais frequente do código; em caso de empate, a primeira por ordem alfabética). 'N_DESCRIPTIONS' indica quantas descrições diferentes o código tem na origem.
+# 'encode_codes' substitui, na tabela de factos, o código e a descrição pela chave inteira; 'decode_codes' volta a juntar o código e a descrição canónica (em 'broadcast', porque a dimensão é pequena), apenas para a visualização dos resultados.
+# Desta forma as agregações e junções sobre as condições transportam uma chave 'int' em vez das descrições completas ('string'), o que reduz os 'bytes' de 'shuffle' e a memória utilizada.
+
+def code_dimension(df, code="CODE", description="DESCRIPTION", key="CODE_KEY"):
+    counts = df.groupBy(code, description).count()
+    by_code = Window.partitionBy(code)
+    return (
+        counts.withColumn(
+            "RANK",
+            F.row_number().over(by_code.orderBy(F.desc("count"), description)),
+        )
+        .withColumn("N_DESCRIPTIONS", F.count(description).over(by_code))
+        .filter(F.col("RANK") == 1)
+        .select(
+            F.dense_rank().over(Window.orderBy(code)).cast(IntegerType()).alias(key),
+            code,
+            description,
+            F.col("N_DESCRIPTIONS").cast(IntegerType()).alias("N_DESCRIPTIONS"),
+        )
+    )
+
+
+def encode_codes(df, dimension, code="CODE", description="DESCRIPTION", key="CODE_KEY"):
+    return df.join(F.broadcast(dimension.select(code, key)), on=code, how="left").drop(
+        code, description
+    )
+
+
+def decode_codes(df, dimension, code="CODE", description="DESCRIPTION", key="CODE_KEY"):
+    return df.join(
+        F.broadcast(dimension.select(key, code, description)), on=key, how="left"
+    )
+
+# COMMAND ----------
+
+# Histograma calculado no 'cluster' ('histogram').
+# Os limites dos intervalos ('bins') são calculados com uma única agregação, e a contagem por intervalo com um 'Bucketizer' seguido de um 'groupBy': apenas as contagens (no máximo 'bins' linhas) são enviadas para o 'notebook', em vez de todas as linhas de 'df'.
+# 'method' define os intervalos: 'fixed' (intervalos de largura igual entre o mínimo e o máximo), 'integer' (largura inteira, alinhada com números inteiros, para variáveis discretas como a idade, em que cada intervalo contém sempre o mesmo número de valores possíveis) e 'quantile' (intervalos com aproximadamente o mesmo número de observações, obtidos com 'percentile_approx').
+# O resultado é uma tabela 'pandas' com o limite inferior ('LOWER'), o limite superior ('UPPER') e a contagem ('COUNT') de cada intervalo, incluindo os intervalos vazios. Os valores nulos são ignorados.
+
+HISTOGRAM_METHODS = ("fixed", "integer", "quantile")
+
+
+def histogram_edges(df, column, bins=100, method="fixed", rel_error=0.0001):
+    if method not in HISTOGRAM_METHODS:
+        raise ValueError(f"Unsupported histogram method: {method!r}")
+    if method == "quantile":
+        quantiles = [i / bins for i in range(bins + 1)]
+        edges = df.agg(
+            F.percentile_approx(F.col(column), quantiles, max(1, int(1 / rel_error)))
+        ).collect()[0][0]
+        return sorted(set(float(edge) for edge in edges or []))
+    minimum, maximum = df.agg(F.min(column), F.max(column)).collect()[0]
+    if minimum is None:
+        return []
+    if method == "integer":
+        lower = int(np.floor(minimum))
+        width = max(1, int(np.ceil((int(np.floor(maximum)) - lower + 1) / bins)))
+        count = int(np.floor(maximum) - lower) // width + 1
+        return [float(lower + i * width) for i in range(count + 1)]
+    if minimum == maximum:
+        return [float(minimum), float(maximum) + 1.0]
+    width = (maximum - minimum) / bins
+    return [float(minimum + i * width) for i in range(bins)] + [float(maximum)]
+
+
+def histogram(df, column, bins=100, method="fixed", rel_error=0.0001):
+    edges = histogram_edges(df, column, bins, method, rel_error)
+    if len(edges) < 2:
+        return pd.DataFrame(columns=["BIN", "LOWER", "UPPER", "COUNT"])
+    bucketizer = Bucketizer(
+        splits=[-float("inf")] + edges[1:-1] + [float("inf")],
+        inputCol=column,
+        outputCol="BIN",
+        handleInvalid="skip",
+    )
+    counts = (
+        bucketizer.transform(df.select(F.col(column).cast("double").alias(column)))
+        .groupBy("BIN")
+        .count()
+        .toPandas()
+    )
+    result = pd.DataFrame(
+        {
+            "BIN": range(len(edges) - 1),
+            "LOWER": edges[:-1],
+            "UPPER": edges[1:],
+        }
+    )
+    result["COUNT"] = (
+        result["BIN"]
+        .map(dict(zip(counts["BIN"].astype(int), counts["count"])))
+        .fillna(0)
+        .astype(int)
+    )
+    return result
+
+# COMMAND ----------
+
+# Gestão da cache dos DataFrames reutilizados em várias perguntas ('FrameCache').
+# Sem cache, cada '.display()' / '.count()' volta a executar toda a linhagem do DataFrame, incluindo a leitura do SF.
+# 'register(name, df)' regista um DataFrame com o número de utilizações previstas nesta execução; se esse número for igual ou superior a 'min_uses' (ou desconhecido), o DataFrame é guardado em cache ('persist') com o nível 'storage_level'.
+# As utilizações previstas vêm do plano 'FRAME_USES' (as perguntas que utilizam cada DataFrame, uma entrada por 'get'), em vez de um número escrito em cada 'register'; 'uses=' continua a permitir indicar o número diretamente.
+# Cada utilização é feita através de 'get(name)', que conta as utilizações. Depois da última utilização prevista, o DataFrame é retirado da cache ('unpersist') na operação seguinte da 'FrameCache' (e não imediatamente, porque a última utilização ainda está a decorrer).
+# Um 'get' depois de o DataFrame ter sido libertado (mais utilizações do que as previstas) emite um aviso ('warnings.warn') e devolve o DataFrame sem cache, que volta a ser calculado a partir da linhagem.
+# A linhagem é tida em conta: um DataFrame registado com 'parents' (DataFrames dos quais deriva) mantém esses DataFrames em cache até ele próprio ser libertado.
+# 'memory()' mostra a memória e o disco ocupados por cada DataFrame em cache ('getRDDStorageInfo') e 'stats()' as utilizações previstas e efetivas de cada um, assinalando ('Diferente do previsto') os DataFrames em que são diferentes: o plano 'FRAME_USES' deve então ser corrigido.
+# Com 'enabled=False' nada é guardado em cache, o que permite comparar o tempo total da EDA com e sem a cache.
+
+class FrameCache:
+    def __init__(
+        self,
+        min_uses=2,
+        storage_level=StorageLevel.MEMORY_AND_DISK,
+        enabled=True,
+        plan=None,
+    ):
+        self.min_uses = min_uses
+        self.storage_level = storage_level
+        self.enabled = enabled
+        self.plan = plan or {}
+        self._frames = {}
+
+    def register(self, name, df, uses=None, parents=()):
+        if uses is None and name in self.plan:
+            uses = len(self.plan[name])
+        persisted = self.enabled and (uses is None or uses >= self.min_uses)
+        if persisted:
+            df = df.persist(self.storage_level)
+        self._frames[name] = {
+            "df": df,
+            "uses": uses,
+            "gets": 0,
+            "parents": list(parents),
+            "persisted": persisted,
+            "released": False,
+        }
+        self.release_finished()
+        return df
+
+    def get(self, name):
+        self.release_finished()
+        entry = self._frames[name]
+        entry["gets"] += 1
+        if entry["persisted"] and entry["released"]:
+            warnings.warn(
+                f"{name} used {entry['gets']} times, planned {entry['uses']}: "
+                "it was already released and is recomputed without cache"
+            )
+        return entry["df"]
+
+    def _finished(self, name):
+        # Um DataFrame está terminado quando já foi libertado, ou quando já teve todas as utilizações previstas e todos os DataFrames que dele derivam também estão terminados.
+        entry = self._frames[name]
+        if entry["released"]:
+            return True
+        if entry["uses"] is None or entry["gets"] < entry["uses"]:
+            return False
+        return all(
+            self._finished(child)
+            for child, child_entry in self._frames.items()
+            if name in child_entry["parents"]
+        )
+
+    def release(self, name):
+        entry = self._frames[name]
+        if entry["persisted"] and not entry["released"]:
+            entry["df"].unpersist()
+        entry["released"] = True
+
+    def release_finished(self):
+        for name, entry in self._frames.items():
+            if entry["persisted"] and not entry["released"] and self._finished(name):
+                self.release(name)
+
+    def release_all(self):
+        for name in self._frames:
+            self.release(name)
+
+    def _rdd_id(self, df):
+        cached = spark._jsparkSession.sharedState().cacheManager().lookupCachedData(df._jdf)
+        if not cached.isDefined():
+            return None
+        return cached.get().cachedRepresentation().cacheBuilder().cachedColumnBuffers().id()
+
+    def memory(self):
+        names = {}
+        for name, entry in self._frames.items():
+            if entry["persisted"] and not entry["released"]:
+                names[self._rdd_id(entry["df"])] = name
+        return pd.DataFrame(
+            [
+                {
+                    "DataFrame": names.get(info.id()),
+                    "RDD": info.id(),
+                    "Partições em cache": info.numCachedPartitions(),
+                    "Memória (MB)": round(info.memSize() / 1024**2, 2),
+                    "Disco (MB)": round(info.diskSize() / 1024**2, 2),
+                }
+                for info in spark.sparkContext._jsc.sc().getRDDStorageInfo()
+            ]
+        )
+
+    def stats(self):
+        return pd.DataFrame(
+            [
+                {
+                    "DataFrame": name,
+                    "Utilizações previstas": entry["uses"],
+                    "Utilizações": entry["gets"],
+                    "Em cache": entry["persisted"] and not entry["released"],
+                    "Libertado": entry["persisted"] and entry["released"],
+                    "Diferente do previsto": entry["uses"] is not None
+                    and entry["gets"] != entry["uses"],
+                }
+                for name, entry in self._frames.items()
+            ]
+        )
+
+
+# Plano de utilizações: para cada DataFrame registado, as perguntas em que é utilizado com 'frame_cache.get' (uma entrada por utilização). Ao acrescentar ou retirar um 'get' numa pergunta, a lista correspondente tem de ser atualizada; o relatório no fim da EDA ('frame_cache.stats()') assinala as diferenças.
+
+FRAME_USES = {
+    "df_patients": ("3.2", "4", "4", "5", "5", "10"),
+    "df_patients_dim": ("10", "14"),
+    "df_condition_duration_3": ("10.2", "10.2", "10.2", "10.2", "11", "14"),
+    "df_bmi": ("17", "18", "18.1.1"),
+    "df_bmi_anomaly": ("18", "18", "18.4"),
+}
+
+frame_cache = FrameCache(
+    min_uses=2, storage_level=StorageLevel.MEMORY_AND_DISK, plan=FRAME_USES
+)
+eda_start_time = time.time()
+
+# COMMAND ----------
+
+# Cache de resultados para visualização ('ResultCache').
+# Várias células mostram exatamente o mesmo resultado (por exemplo 'df_conditions_count' nas perguntas 8 e 8.1); cada '.display()' voltaria a executar o plano completo.
+# 'result_cache.display(df)' identifica o resultado pelo plano lógico otimizado (normalizado, 'canonicalized'), pelos nomes e tipos das colunas e pela impressão digital das fontes ('fingerprint(df)').
+# Em 'result_cache' a impressão digital são apenas as entradas do manifesto da cache de 'staging' das tabelas lidas pelo plano (os ficheiros de 'df.inputFiles()'): a cópia de outra tabela em segundo plano ('preload') não altera a chave, e uma nova cópia de uma das tabelas lidas sim. Planos que não leem ficheiros da 'staging' (por exemplo leituras diretas do SF) não têm impressão digital ('None') e não são guardados.
+# Apenas resultados pequenos são guardados: planos com um nó de agregação ou de limite ('Aggregate', 'GlobalLimit', 'LocalLimit' ou 'Tail', procurados nas classes dos nós do plano e não no texto) e com no máximo 'max_rows' linhas. Os restantes DataFrames são mostrados normalmente, sem cache.
+# Os resultados ficam em memória (tabelas 'pandas') até 'max_bytes'; acima desse limite são descartados os resultados utilizados há mais tempo ('LRU'). Com 'disk_dir' os resultados são também guardados no disco local, de onde são lidos quando já não estão em memória.
+# 'stats()' mostra as contagens de resultados servidos da memória ('hits'), do disco ('disk_hits'), executados ('misses') e não guardados ('bypassed').
+
+class ResultCache:
+    CACHEABLE_NODES = ("Aggregate", "GlobalLimit", "LocalLimit", "Tail")
+
+    def __init__(
+        self, max_bytes=64 * 1024**2, max_rows=10000, disk_dir=None, fingerprint=None
+    ):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.disk_dir = disk_dir
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def key(self, df):
+        plan = df._jdf.queryExecution().optimizedPlan().canonicalized().toString()
+        sources = self.fingerprint(df) if self.fingerprint else ""
+        if sources is None:
+            return None
+        return hashlib.sha256(
+            "\n".join([plan, df.schema.simpleString(), sources]).encode("utf-8")
+        ).hexdigest()
+
+    def _plan_nodes(self, plan):
+        nodes = [plan.getClass().getSimpleName()]
+        children = plan.children()
+        for i in range(children.size()):
+            nodes.extend(self._plan_nodes(children.apply(i)))
+        return nodes
+
+    def _cacheable(self, df):
+        nodes = self._plan_nodes(df._jdf.queryExecution().optimizedPlan())
+        return any(node in self.CACHEABLE_NODES for node in nodes)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _put(self, key, result):
+        size = int(result.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (result, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def get(self, df):
+        key = self.key(df) if self._cacheable(df) else None
+        if key is None:
+            self.bypassed += 1
+            return None
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            self.disk_hits += 1
+            result = pd.read_pickle(self._disk_path(key))
+            self._put(key, result)
+            return result
+        self.misses += 1
+        result = df.limit(self.max_rows + 1).toPandas()
+        if len(result) > self.max_rows:
+            return None
+        self._put(key, result)
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            result.to_pickle(self._disk_path(key))
+        return result
+
+    def display(self, df):
+        result = self.get(df)
+        if result is None:
+            display(df)
+        else:
+            display(result)
+
+    def clear(self, disk=False):
+        self._entries.clear()
+        self._bytes = 0
+        if disk and self.disk_dir:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+def staging_fingerprint(df, stage_cache):
+    files = df.inputFiles()
+    if not files:
+        return None
+    entries = {
+        key: entry
+        for key, entry in stage_cache.manifest().items()
+        if any(f"/{os.path.basename(stage_cache.path_for(key))}/" in file for file in files)
+    }
+    if not entries:
+        return None
+    return json.dumps(entries, sort_keys=True)
+
+
+result_cache = ResultCache(
+    max_bytes=64 * 1024**2,
+    disk_dir="/tmp/eda_result_cache",
+    fingerprint=lambda df: staging_fingerprint(df, francisco.stage_cache),
 )
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Leituras antecipadas das tabelas do SF
+
+# COMMAND ----------
+
+# As tabelas da EDA são lidas do SF através de um catálogo ('Catalog'): cada tabela é lida apenas no primeiro acesso ('eda_catalog.df_patients'), com as colunas utilizadas na EDA ('EDA_TABLES', 'columns').
+# As três tabelas são pedidas logo no início ('preload' com 'wait=False'), em segundo plano, em vez de cada leitura bloquear o 'notebook' apenas quando a tabela é necessária (DF_PATIENTS na pergunta 1, DF_CONDITIONS na 8 e DF_OBSERVATIONS na 15).
+# Com 'prefer_cache=True' a cópia local de cada tabela ('staging') é atualizada em segundo plano enquanto as primeiras perguntas correm; o primeiro acesso só espera se a leitura dessa tabela ainda não terminou.
+
+EDA_TABLES = {
+    "patients": (
+        "DF_PATIENTS",
+        ["ID", "BIRTHDATE", "DEATHDATE", "FIRST", "LAST", "RACE", "ETHNICITY", "GENDER"],
+    ),
+    "conditions": ("DF_CONDITIONS", ["START", "STOP", "PATIENT", "CODE", "DESCRIPTION"]),
+    "observations": (
+        "DF_OBSERVATIONS",
+        ["DATE", "PATIENT", "CODE", "DESCRIPTION", "VALUE_NUM", "VALUE_TEXT", "UNITS"],
+    ),
+}
+
+
+def read_eda_table(name):
+    table, columns = EDA_TABLES[name]
+    return francisco.read_table(
+        "EDIT2023",
+        "PROJETO_FINAL",
+        table,
+        columns=columns,
+        prefer_cache=True,
+        raise_errors=True,
+    )
+
+
+eda_catalog = Catalog(read_eda_table, EDA_TABLES)
+eda_catalog.preload(EDA_TABLES, wait=False)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC #### 1. Qual é quantidade de pessoas do género feminino e masculino e a sua percentagem sobre o total de doentes? 
 # MAGIC
@@ -158,27 +2046,30 @@ francisco = DatabricksSnowflakeConnection(
 # COMMAND ----------
 
 # importação e leitura de DF_PATIENTS desde o SF, com recurso às propriedades da classe 'DatabricksSnowflakeConnection' previamente definida.
+# A leitura foi pedida no início da EDA ('eda_catalog').
 
-df_patients = francisco.read_table(
-    "EDIT2023", "PROJETO_FINAL", "DF_PATIENTS", query=None, type=True
-)
+df_patients = eda_catalog.df_patients
 
 # COMMAND ----------
 
-# Total de pacientes.
-patients_total = df_patients.count()
+# As distribuições do género (pergunta 1), da etnia (pergunta 6) e da raça (pergunta 7) são calculadas todas de uma vez, numa única passagem sobre 'df_patients' (ver 'categorical_distribution').
 
-# Contagem de pacientes por género (Masculino (M) e Feminino (F)).
-df_patients_gender = df_patients.groupBy("GENDER").count()
+patients_distribution = categorical_distribution(
+    df_patients, ["GENDER", "ETHNICITY", "RACE"]
+)
+
+# Total de pacientes.
+patients_total = int(
+    patients_distribution.loc[patients_distribution["COLUMN"] == "GENDER", "TOTAL"].iloc[0]
+)
 
-# Percentagem (%) do género sobre o total de doentes.
-df_patients_gender = df_patients_gender.withColumn(
-    "GENDER_DISTRIBUTION (%)",
-    F.round((df_patients_gender["count"] / patients_total) * 100, 2),
+# Contagem de pacientes por género (Masculino (M) e Feminino (F)) e percentagem (%) do género sobre o total de doentes.
+df_patients_gender = distribution_of(
+    patients_distribution, "GENDER", "GENDER_DISTRIBUTION (%)", 2
 )
 
 # O seguinte DF incluí as informações relativas à quantidade de pessoas do género feminino e masculino e a sua percentagem sobre o total de doentes
-df_patients_gender.display()
+display(df_patients_gender)
 
 
 # COMMAND ----------
@@ -188,7 +2079,7 @@ df_patients_gender.display()
 
 # COMMAND ----------
 
-df_patients_gender.display()
+display(df_patients_gender)
 
 # COMMAND ----------
 
@@ -247,8 +2138,12 @@ df_patients = df_patients.withColumn(
     "AGE", F.when(df_patients["AGE"] == -1, F.lit(0)).otherwise(df_patients["AGE"])
 )
 
+# 'df_patients' já tem todas as colunas utilizadas nas perguntas seguintes, e é reutilizado nas perguntas 3, 4, 5 e 10 (utilizações previstas em 'FRAME_USES'): fica em cache ('frame_cache').
+df_patients = frame_cache.register("df_patients", df_patients)
+
 # COMMAND ----------
 
+df_patients = frame_cache.get("df_patients")
 df_patients.select("ID", "AGE").display()
 
 # COMMAND ----------
@@ -259,36 +2154,39 @@ df_patients.select("ID", "AGE").display()
 
 # COMMAND ----------
 
+# Idade máxima, idade mínima, média e mediana numa única passagem sobre 'df_patients' (ver 'describe_numeric').
+# A mediana é obtida com o mesmo erro relativo utilizado anteriormente com 'approxQuantile' (0.0001).
+
+df_patients = frame_cache.get("df_patients")
+age_stats = describe_numeric(df_patients, ["AGE"], quantiles=[0.5], rel_error=0.0001)
+display(age_stats)
+
+# COMMAND ----------
+
 # Idade máxima.
 
-df_patients_max = df_patients.select(
-    F.round(F.max(df_patients["AGE"])).alias("max_age")
-)
-df_patients_max.display()
+max_age = round(age_stats.loc["AGE", "max"])
+print(max_age)
 
 # COMMAND ----------
 
 # Idade mínima.
 
-df_patients_min = df_patients.select(
-    F.round(F.min(df_patients["AGE"])).alias("min_age")
-)
-df_patients_min.display()
+min_age = round(age_stats.loc["AGE", "min"])
+print(min_age)
 
 # COMMAND ----------
 
 # Média das idades.
 
-df_patients_mean = df_patients.select(
-    F.round(F.avg(df_patients["AGE"])).alias("avg_age")
-)
-df_patients_mean.display()
+avg_age = round(age_stats.loc["AGE", "mean"])
+print(avg_age)
 
 # COMMAND ----------
 
 # Mediana das idades.
 
-median_age = df_patients.approxQuantile("AGE", [0.5], 0.0001)[0]
+median_age = age_stats.loc["AGE", "q0.5"]
 display(median_age)
 
 # Neste contexto o resultado não é um Dataframe, mas sim um valor escalar 'float'.
@@ -296,12 +2194,46 @@ display(median_age)
 
 # COMMAND ----------
 
+# Comparação entre o cálculo anterior (três 'select' + 'approxQuantile', uma passagem cada) e 'describe_numeric' (uma única passagem): número de 'jobs' Spark e tempo de execução.
+
+df_patients = frame_cache.get("df_patients")
+_, age_benchmark_before = measure_jobs(
+    lambda: (
+        df_patients.select(F.max("AGE")).collect(),
+        df_patients.select(F.min("AGE")).collect(),
+        df_patients.select(F.avg("AGE")).collect(),
+        df_patients.approxQuantile("AGE", [0.5], 0.0001),
+    ),
+    "AGE - antes (4 passagens)",
+)
+_, age_benchmark_after = measure_jobs(
+    lambda: describe_numeric(df_patients, ["AGE"], quantiles=[0.5]),
+    "AGE - describe_numeric (1 passagem)",
+)
+
+display(pd.DataFrame([age_benchmark_before, age_benchmark_after]))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ##### 5. Faça um histograma com 100 bins (intervalos) da idade das pessoas
 
 # COMMAND ----------
 
-display(df_patients.select('ID','AGE'))
+# Histograma calculado no 'cluster' ('histogram'): apenas as contagens de cada intervalo são enviadas para o 'notebook', em vez da idade de todos os doentes.
+# Os intervalos são alinhados com idades inteiras ('method="integer"'). Como há 111 idades possíveis (0 a 110 anos), 100 intervalos não podem ter todos o mesmo número de idades; cada intervalo tem por isso 2 idades completas, e nenhum intervalo fica com mais idades do que os vizinhos (ver 5.1).
+
+df_patients = frame_cache.get("df_patients")
+age_histogram = histogram(df_patients, "AGE", bins=100, method="integer")
+display(age_histogram)
+
+# COMMAND ----------
+
+# Histograma da idade com intervalos de largura fixa (100 'bins', como no enunciado) e com intervalos por quantis (cada intervalo com aproximadamente o mesmo número de doentes).
+
+df_patients = frame_cache.get("df_patients")
+display(histogram(df_patients, "AGE", bins=100, method="fixed"))
+display(histogram(df_patients, "AGE", bins=20, method="quantile"))
 
 # COMMAND ----------
 
@@ -316,6 +2248,7 @@ display(df_patients.select('ID','AGE'))
 # MAGIC Ao criar um histograma, os 'bins' geralmente são intervalos de valores, e a cada observação (paciente) é atribuída a um desses 'bins' com base no valor da sua idade. Se houver sobreposição entre os 'bins' ou se houver uma escolha específica na forma como os 'bins' são definidos, a contagem pode-se acumular em determinadas faixas etárias. O fato de haver 100 bins para representar 110 idades sugere que pode haver sobreposição ou acumulação de contagens em alguns dos 'bins'. Isso pode criar picos aparentes em certas faixas etárias. 
 # MAGIC Aliado a isto, os picos observados podem também ser influênciados por eventos demográficos, históricos (como guerras e pandemias), ou outras influências específicas em determinadas faixas etárias (aumento natural de nascimentos, concentração de pessoas que atingiram uma idade bastante avançada, etc.).  
 # MAGIC Ajustar a largura dos 'bins' ou escolher uma abordagem diferente na construção do histograma pode fornecer uma representação mais fiel da distribuição de idades. Esta acumulação de contagem em determinados 'bins', poderia eventualmente ser minimizada se o número de 'bins' fosse igual ou maior (e não menor) em relação ao numero de idades representadas (110 neste caso específico).
+# MAGIC Nota: o histograma da pergunta 5 passou a ser calculado com intervalos alinhados com idades inteiras ('histogram(..., method="integer")'), em que todos os intervalos contêm o mesmo número de idades, pelo que estes picos artificiais deixam de aparecer.
 
 # COMMAND ----------
 
@@ -324,20 +2257,14 @@ display(df_patients.select('ID','AGE'))
 
 # COMMAND ----------
 
-# Total de pacientes
-patients_total = df_patients.count()
-
-# Contagem de pacientes por etnia
-df_patients_ethnicity_count = df_patients.groupBy("ETHNICITY").count()
+# A contagem de pacientes por etnia e a sua distribuição sobre o total de doentes já foram calculadas na pergunta 1 ('patients_distribution'), pelo que não é necessária uma nova leitura de 'df_patients'.
 
-# Coluna para determinar a distribuição das etnias
-df_patients_ethnicity_count = df_patients_ethnicity_count.withColumn(
-    "ETHNICITY_DISTRIBUTION",
-    F.round((df_patients_ethnicity_count["count"] / patients_total) * 100, 1),
+df_patients_ethnicity_count = distribution_of(
+    patients_distribution, "ETHNICITY", "ETHNICITY_DISTRIBUTION", 1
 )
 
 # O seguinte DF incluí as informações relativas à distribuídas cada umas das etnias sobre o total dos doentes.
-df_patients_ethnicity_count.display()
+display(df_patients_ethnicity_count)
 
 # COMMAND ----------
 
@@ -346,16 +2273,13 @@ df_patients_ethnicity_count.display()
 
 # COMMAND ----------
 
-# Contagem de pacientes por raça
-df_patients_race_count = df_patients.groupBy("RACE").count()
+# Contagem de pacientes por raça e percentagem das raças sobre o total da população por ordem decrescente da distribuição (também calculadas na pergunta 1).
 
-# Coluna para determinar a percentagem das raças sobre o total da população por ordem decrescente da distribuição
-df_patients_race_count = df_patients_race_count.withColumn(
-    "RACE_DISTRIBUTION",
-    F.round((df_patients_race_count["count"] / patients_total) * 100, 1),
-).orderBy("RACE_DISTRIBUTION", ascending=False)
+df_patients_race_count = distribution_of(
+    patients_distribution, "RACE", "RACE_DISTRIBUTION", 1
+)
 
-df_patients_race_count.display()
+display(df_patients_race_count)
 
 # A seguinte tabela fornece as informações relativas ao número de doentes por raça e as suas percentagens sobre o total da população.
 # Através da análise da tabela podemos verificar que a raça mais representada é 'white' com 10328 doentes e 83.6% do total da população.
@@ -365,26 +2289,28 @@ df_patients_race_count.display()
 
 # COMMAND ----------
 
-# Podemos retirar os valores máximos e mínimos diretamente da tabela anterior.
+# Podemos retirar os valores máximos e mínimos diretamente da tabela anterior ('TOP_K' e 'BOTTOM_K' de 'patients_distribution'), sem nenhum novo 'job' Spark.
 
 # Valor máximo (raça com maior número de doentes e a sua percentagem no total de doentes):
 
-df_patients_race_count_max = df_patients_race_count.orderBy(
-    "RACE_DISTRIBUTION", ascending=False
-).first()
-print(df_patients_race_count_max)
+df_patients_race_count_max = distribution_of(
+    patients_distribution[patients_distribution["TOP_K"]], "RACE", "RACE_DISTRIBUTION", 1
+).iloc[0]
+print(df_patients_race_count_max.to_dict())
 
-# Utilizo o método 'print()' porque o resultado anterior deixa de ser um Dataframe e passa a ser 'Row'. 
-# Para usar 'display()' ou 'show()' teria de converter de 'Row' para 'DataFrame': df_patients_race_count_max = spark.createDataFrame([df_patients_race_count_max])
+# Utilizo o método 'print()' porque o resultado anterior deixa de ser um Dataframe e passa a ser uma linha ('Series').
 
 # COMMAND ----------
 
 # Valor mínimo (raça com menor número de doentes e a sua percentagem no total de doentes):
 
-df_patients_race_count_min = df_patients_race_count.orderBy(
-    "RACE_DISTRIBUTION", ascending=True
-).first()
-print(df_patients_race_count_min)
+df_patients_race_count_min = distribution_of(
+    patients_distribution[patients_distribution["BOTTOM_K"]],
+    "RACE",
+    "RACE_DISTRIBUTION",
+    1,
+).iloc[0]
+print(df_patients_race_count_min.to_dict())
 
 # COMMAND ----------
 
@@ -394,22 +2320,65 @@ print(df_patients_race_count_min)
 # COMMAND ----------
 
 # importação e leitura de DF_CONDITIONS desde o SF, com recurso às propriedades da classe 'DatabricksSnowflakeConnection' previamente definida.
+# A leitura foi pedida no início da EDA ('eda_catalog').
 
-df_conditions = francisco.read_table(
-    "EDIT2023", "PROJETO_FINAL", "DF_CONDITIONS", query=None, type=True
-)
+df_conditions = eda_catalog.df_conditions
 df_conditions.display()
 
 # COMMAND ----------
 
-df_conditions_count = (
-    df_conditions.groupBy("CODE", "DESCRIPTION")
+# Dimensão dos códigos das condições ('code_dimension'), construída uma única vez: chave inteira ('CODE_KEY'), descrição canónica e número de descrições diferentes de cada código.
+# A tabela de factos das condições ('df_conditions_fact') passa a ter apenas a chave inteira, em vez do código e da descrição; as descrições são juntadas apenas na visualização ('decode_codes').
+
+df_condition_codes = frame_cache.register(
+    "df_condition_codes", code_dimension(df_conditions)
+)
+df_conditions_fact = encode_codes(df_conditions, df_condition_codes)
+
+df_condition_codes.display()
+
+# COMMAND ----------
+
+# A contagem é feita pela chave inteira; o código e a descrição são acrescentados apenas às 15 condições do resultado.
+
+df_conditions_count = decode_codes(
+    df_conditions_fact.groupBy("CODE_KEY")
     .count()
     .orderBy("count", ascending=False)
-    .limit(15)
-)
+    .limit(15),
+    df_condition_codes,
+).select("CODE", "DESCRIPTION", "count").orderBy("count", ascending=False)
+
+result_cache.display(df_conditions_count)
+
+# COMMAND ----------
+
+# Comparação entre a contagem das condições por (código, descrição) e pela chave inteira ('CODE_KEY'): número de 'jobs', tempo de execução e 'bytes' escritos em 'shuffle'.
+
+conditions_benchmark = []
+for label, count_function in [
+    (
+        "groupBy(CODE, DESCRIPTION)",
+        lambda: df_conditions.groupBy("CODE", "DESCRIPTION").count().collect(),
+    ),
+    ("groupBy(CODE_KEY)", lambda: df_conditions_fact.groupBy("CODE_KEY").count().collect()),
+    (
+        "count_distinct(DESCRIPTION) por doente",
+        lambda: df_conditions.groupBy("PATIENT")
+        .agg(F.count_distinct("DESCRIPTION"))
+        .collect(),
+    ),
+    (
+        "count_distinct(CODE_KEY) por doente",
+        lambda: df_conditions_fact.groupBy("PATIENT")
+        .agg(F.count_distinct("CODE_KEY"))
+        .collect(),
+    ),
+]:
+    _, benchmark = measure_jobs(count_function, label)
+    conditions_benchmark.append(benchmark)
 
-df_conditions_count.display()
+display(pd.DataFrame(conditions_benchmark))
 
 # COMMAND ----------
 
@@ -418,7 +2387,7 @@ df_conditions_count.display()
 
 # COMMAND ----------
 
-df_conditions_count.display()
+result_cache.display(df_conditions_count)
 
 # COMMAND ----------
 
@@ -429,7 +2398,9 @@ df_conditions_count.display()
 
 # Identificação dos códigos ('CODE') com mais de uma ocorrência (repetidos).
 
-df_code_count = df_conditions.groupBy("CODE").count().orderBy("count", ascending=False)
+df_code_count = decode_codes(
+    df_conditions_fact.groupBy("CODE_KEY").count(), df_condition_codes
+).select("CODE", "count").orderBy("count", ascending=False)
 df_code_count_repeated = df_code_count.filter(df_code_count["count"] > 1)
 
 df_code_count_repeated.display()
@@ -438,7 +2409,7 @@ df_code_count_repeated.display()
 
 # Quantificação dos códigos ('CODE') com mais de uma ocorrência (repetidos).
 
-df_code_count_repeated.count()
+row_counts.count(df_code_count_repeated)
 
 # 172 códigos de doenças ('CODE') tem mais de uma ocorrência (repetidos).
 
@@ -449,17 +2420,13 @@ df_code_count_repeated.count()
 
 # COMMAND ----------
 
-df_code_descripton = df_conditions.select("CODE", "DESCRIPTION")
-
-df_code_descripton_repeated = df_code_descripton.join(
-    df_code_count_repeated, on="CODE", how="inner"
-)
+# O número de descrições diferentes de cada código ('N_DESCRIPTIONS') já foi calculado na dimensão dos códigos ('df_condition_codes'), pelo que não é necessário voltar a juntar e agrupar as condições.
 
-different_description_per_code = df_code_descripton_repeated.groupBy("CODE").agg(
-    F.count_distinct("DESCRIPTION")
-)
+different_description_per_code = df_condition_codes.join(
+    df_code_count_repeated.select("CODE"), on="CODE", how="inner"
+).select("CODE", F.col("N_DESCRIPTIONS").alias("count(DESCRIPTION)"))
 
-different_description_per_code.display()
+result_cache.display(different_description_per_code)
 
 # Cada um dos códigos identificados tem apenas uma descrição diferente (à exceção de '233604007' e '427089005').
 # Os códigos '233604007' e '427089005' tem duas descrições diferentes, respetivamente.
@@ -471,7 +2438,7 @@ different_description_per_code.display()
 different_description_per_code = different_description_per_code.filter(
     different_description_per_code["count(DESCRIPTION)"] > 1
 )
-different_description_per_code.display()
+result_cache.display(different_description_per_code)
 
 # Os códigos '233604007' e '427089005' tem duas descrições diferentes, ou seja mais do que uma descrição.
 
@@ -482,15 +2449,16 @@ different_description_per_code.display()
 
 # COMMAND ----------
 
-# Concatenar as duas colunas com separador ' - '.
+# A unificação é feita na dimensão dos códigos ('df_condition_codes'): cada código tem uma única descrição canónica (a mais frequente) e uma chave inteira ('CODE_KEY').
+# As condições ('df_conditions_fact') guardam apenas a chave, pelo que a concatenação do código com a descrição (separador ' - ') é feita uma vez por código, e não em todas as linhas das condições.
 
-df_code_description_unified = df_conditions.withColumn(
+df_code_description_unified = df_condition_codes.withColumn(
     "UNIFIED_CODE_DESCRIPTION",
-    F.concat(df_conditions["CODE"], F.lit(" - "), df_conditions["DESCRIPTION"]),
+    F.concat(
+        df_condition_codes["CODE"], F.lit(" - "), df_condition_codes["DESCRIPTION"]
+    ),
 )
-df_code_description_unified.select(
-    "PATIENT", "CODE", "DESCRIPTION", "UNIFIED_CODE_DESCRIPTION"
-).display()
+df_code_description_unified.display()
 
 # COMMAND ----------
 
@@ -500,22 +2468,36 @@ df_code_description_unified.select(
 # COMMAND ----------
 
 # Filtrar o DF apenas com as colunas de interesse.
+# A mesma dimensão de doentes ('df_patients_dim') é utilizada nas duas junções desta análise (pergunta 10 e pergunta 14), pelo que já inclui o primeiro e o último nome.
 
-df_patients_filtered = df_patients.select(
-    "ID", "BIRTHDATE", "DEATHDATE", "AGE_DATE", "AGE"
+df_patients_dim = frame_cache.register(
+    "df_patients_dim",
+    frame_cache.get("df_patients").select(
+        "ID", "BIRTHDATE", "DEATHDATE", "AGE_DATE", "AGE", "FIRST", "LAST"
+    ),
+    parents=["df_patients"],
 )
+df_patients_filtered = frame_cache.get("df_patients_dim").drop("FIRST", "LAST")
 
 # COMMAND ----------
 
 # Mudar nome da coluna 'PATIENTS' para 'ID' de 'DF_CONDITIONS', para conseguir fazer o '.join()' com a tabela 'df_patients'.
+# A junção é feita com 'dimension_join': a tabela dos doentes é muito mais pequena do que a das condições, pelo que é enviada em 'broadcast' e as condições não são redistribuídas.
 
-df_conditions_renamed = df_conditions.withColumnRenamed("PATIENT", "ID")
-df_condition_duration = df_conditions_renamed.join(
-    df_patients_filtered, on="ID", how="inner"
+df_conditions_renamed = df_conditions_fact.withColumnRenamed("PATIENT", "ID")
+df_condition_duration = dimension_join(
+    df_conditions_renamed, df_patients_filtered, "ID", how="inner"
 )
 
 # COMMAND ----------
 
+# Verificação do plano físico da junção (esperado: 'BroadcastHashJoin').
+
+print(join_strategy(df_condition_duration))
+df_condition_duration.explain()
+
+# COMMAND ----------
+
 # Cálculo direto da duração das doenças em cada um dos pacientes.
 # Naturalmente irá conter valores nulos, porque em alguns casos 'STOP' é nulo ('null').
 # 'STOP' é nulo em alguns casos porque ou o doente ainda está vivo e ainda padece da doença, ou o doente morreu com a doença.
@@ -526,7 +2508,7 @@ df_condition_duration = df_condition_duration.withColumn(
         F.datediff(df_condition_duration["STOP"], df_condition_duration["START"]),
     ),
 )
-df_condition_duration.select(
+decode_codes(df_condition_duration, df_condition_codes).select(
     "ID", "CODE", "DESCRIPTION", "START", "STOP",  "CONDITION_DURATION_DAYS"
 ).display()
 
@@ -537,36 +2519,60 @@ df_condition_duration.select(
 
 # COMMAND ----------
 
-# Data final da doença ('STOP') em pessoas que já morreram, será a data de morte dessas pessoas ('DEATHDATE').
+# Data final da doença ('STOP') em pessoas que já morreram, será a data de morte dessas pessoas ('DEATHDATE'), quando a doença não tem data final ou quando essa data é posterior à morte.
 # De salientar que neste cálculo existem pessoas que não morreram e que ainda não tem data final de doença ('STOP').
-# Pelo que nesses casos específicos a duração da doença/condição ('CONDITION_DURATION_DAYS_2') continuará a ser valor nulo.
+# Pelo que nesses casos específicos a duração da doença/condição ('CONDITION_DURATION_DAYS_2') continuará a ser valor nulo ('reference_date=None').
+# A duração é calculada por episódio ('condition_episodes'): as linhas repetidas ou sobrepostas da mesma condição no mesmo doente são juntas num único episódio, desde o primeiro diagnóstico ('START') até à última data final ('STOP').
+# Cada episódio tem a duração em dias e em anos como inteiros, e a indicação de doença crónica ('CHRONIC').
 
-df_condition_duration_2 = df_condition_duration.withColumn(
-    "STOP",
-    F.when(
-        df_condition_duration["DEATHDATE"].isNotNull(),
-        df_condition_duration["DEATHDATE"],
-    ).otherwise(df_condition_duration["STOP"]),
+df_condition_episodes = condition_episodes(
+    df_condition_duration, reference_date=None, code="CODE_KEY"
 )
-df_condition_duration_2 = df_condition_duration_2.withColumn(
-    "CONDITION_DURATION_DAYS_2",
-    F.floor(
-        F.datediff(df_condition_duration_2["STOP"], df_condition_duration_2["START"]),
-    ),
+
+df_condition_duration_2 = df_condition_episodes.withColumnRenamed(
+    "DURATION_DAYS", "CONDITION_DURATION_DAYS_2"
 )
 
-df_condition_duration_2.select(
+decode_codes(df_condition_duration_2, df_condition_codes).select(
     "ID",
     "START",
     "STOP",
-    "DEATHDATE",
     "CODE",
     "DESCRIPTION",
+    "N_ROWS",
     "CONDITION_DURATION_DAYS_2",
 ).display()
 
 # COMMAND ----------
 
+# Verificação da escalabilidade de 'condition_episodes' em dados sintéticos com milhões de linhas de condições (tempo por milhão de linhas aproximadamente constante).
+
+episodes_benchmark = []
+for synthetic_rows in (1000000, 2000000, 4000000):
+    synthetic_conditions = spark.range(synthetic_rows).select(
+        (F.col("id") % (synthetic_rows // 20)).cast("string").alias("ID"),
+        (F.col("id") % 7).alias("CODE"),
+        F.lit("condition").alias("DESCRIPTION"),
+        F.date_add(F.to_date(F.lit("2000-01-01")), (F.col("id") % 7000).cast("int")).alias("START"),
+        F.date_add(F.to_date(F.lit("2000-01-01")), (F.col("id") % 7000 + 400).cast("int")).alias("STOP"),
+        F.lit(None).cast(DateType()).alias("DEATHDATE"),
+    )
+    _, benchmark = measure_jobs(
+        lambda: condition_episodes(synthetic_conditions)
+        .write.format("noop")
+        .mode("overwrite")
+        .save(),
+        f"condition_episodes - {synthetic_rows} linhas",
+    )
+    benchmark["Segundos por milhão de linhas"] = round(
+        benchmark["Tempo (segundos)"] / (synthetic_rows / 1000000), 2
+    )
+    episodes_benchmark.append(benchmark)
+
+display(pd.DataFrame(episodes_benchmark))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ##### 10.2. Calcule a média em dias e anos, se for mais de 365 dias transforme a anos.
 
@@ -594,23 +2600,36 @@ df_condition_duration_2 = df_condition_duration_2.na.drop(
 # COMMAND ----------
 
 # Cálculo média dos dias e/ou anos por condição (doença).
-
-df_condition_duration_mean = df_condition_duration_2.groupBy("DESCRIPTION").agg(
-    F.round(F.avg("CONDITION_DURATION_DAYS_2"), 0).alias(
-        "DESCRIPTION_DURATION_DAYS_MEAN"
-    )
-)
+# As durações ficam em colunas inteiras ('int'): até 365 dias, o número de anos é 0. O texto 'less than 1 year' é apenas acrescentado na visualização ('with_duration_label').
+# O agrupamento é feito pela chave inteira da condição ('CODE_KEY'), e a descrição canónica é acrescentada ao resultado (uma linha por condição).
+# Nota: a versão original desta resposta agrupava por 'DESCRIPTION'. Com o agrupamento por código, um código com várias descrições passa a ter uma única linha (com a descrição canónica) e códigos diferentes com a mesma descrição passam a ter linhas separadas; o número de linhas e as médias dessas condições podem por isso diferir dos valores originais (e, na pergunta 12, o número de doenças crónicas).
+
+df_condition_duration_mean = decode_codes(
+    df_condition_duration_2.groupBy("CODE_KEY").agg(
+        F.round(F.avg("CONDITION_DURATION_DAYS_2"), 0)
+        .cast(IntegerType())
+        .alias("DESCRIPTION_DURATION_DAYS_MEAN")
+    ),
+    df_condition_codes,
+).select("DESCRIPTION", "DESCRIPTION_DURATION_DAYS_MEAN")
 df_condition_duration_mean = df_condition_duration_mean.withColumn(
     "DESCRIPTION_DURATION_YEARS_MEAN",
     F.when(
         col("DESCRIPTION_DURATION_DAYS_MEAN") > 365,
         F.floor(col("DESCRIPTION_DURATION_DAYS_MEAN") / 365.25),
-    ).otherwise("less than 1 year"),
+    )
+    .otherwise(0)
+    .cast(IntegerType()),
 )
 
-df_condition_duration_mean.display()
+with_duration_label(
+    df_condition_duration_mean,
+    "DESCRIPTION_DURATION_DAYS_MEAN",
+    "DESCRIPTION_DURATION_YEARS_MEAN",
+    "DESCRIPTION_DURATION_MEAN_LABEL",
+).display()
 
-# Por exemplo: a duração média da condição num paciente que contrai 'Atrial Fibrillation' é de 4214 dias ou 11 anos.
+# Por exemplo: a duração média da condição num paciente que contrai 'Atrial Fibrillation' é de 4214 dias ou 11 anos (valor obtido com o cálculo anterior por linha de 'conditions', antes da junção das linhas em episódios ('condition_episodes')).
 
 # COMMAND ----------
 
@@ -620,24 +2639,48 @@ df_condition_duration_mean.display()
 # COMMAND ----------
 
 # Cálculo média dos dias e/ou anos por pacientes (doentes).
+# O número de anos completos de cada episódio já é calculado em 'condition_episodes' ('DURATION_YEARS', 'int'), e é 0 até 365 dias.
 
-df_condition_duration_3 = df_condition_duration_2.withColumn(
-    "DESCRIPTION_DURATION_YEARS_2",
-    F.when(
-        col("CONDITION_DURATION_DAYS_2") > 365,
-        F.floor(col("CONDITION_DURATION_DAYS_2") / 365.25),
-    ).otherwise("less than 1 year"),
+df_condition_duration_3 = df_condition_duration_2.withColumnRenamed(
+    "DURATION_YEARS", "DESCRIPTION_DURATION_YEARS_2"
 )
 df_condition_duration_3 = df_condition_duration_3.select(
-    "ID", "DESCRIPTION", "CONDITION_DURATION_DAYS_2", "DESCRIPTION_DURATION_YEARS_2"
+    "ID",
+    "CODE_KEY",
+    "CONDITION_DURATION_DAYS_2",
+    "DESCRIPTION_DURATION_YEARS_2",
+    "CHRONIC",
+)
+# 'df_condition_duration_3' é reutilizado nas perguntas 10.2, 11 e 14 (utilizações previstas em 'FRAME_USES'): fica em cache.
+df_condition_duration_3 = frame_cache.register(
+    "df_condition_duration_3", df_condition_duration_3
 )
 
-df_condition_duration_3.display()
+with_duration_label(
+    decode_codes(frame_cache.get("df_condition_duration_3"), df_condition_codes),
+    "CONDITION_DURATION_DAYS_2",
+    "DESCRIPTION_DURATION_YEARS_2",
+    "DESCRIPTION_DURATION_2_LABEL",
+).display()
+
+# COMMAND ----------
+
+# Distribuição da duração das condições por paciente, em anos completos ('histogram', calculado no 'cluster').
+
+display(
+    histogram(
+        frame_cache.get("df_condition_duration_3"),
+        "DESCRIPTION_DURATION_YEARS_2",
+        bins=50,
+        method="integer",
+    )
+)
 
 # COMMAND ----------
 
 # Cálculo da duração média em dias da condição/doença por paciente.
 
+df_condition_duration_3 = frame_cache.get("df_condition_duration_3")
 df_condition_duration_3_days_mean = df_condition_duration_3.select(
     F.round(F.avg(df_condition_duration_3["CONDITION_DURATION_DAYS_2"])).alias(
         "mean_condition_days"
@@ -646,12 +2689,13 @@ df_condition_duration_3_days_mean = df_condition_duration_3.select(
 
 df_condition_duration_3_days_mean.display()
 
-# Em média um paciente contrai uma (qualquer) condição ou doença durante 1672 dias.
+# Em média um paciente contrai uma (qualquer) condição ou doença durante 1672 dias (valor obtido com o cálculo anterior por linha de 'conditions', antes da junção das linhas em episódios ('condition_episodes')).
 
 # COMMAND ----------
 
 # Cálculo da duração média em anos da condição/doença por paciente.
 
+df_condition_duration_3 = frame_cache.get("df_condition_duration_3")
 df_condition_duration_3_years_mean = df_condition_duration_3.select(
     F.round(
         F.avg(df_condition_duration_3["CONDITION_DURATION_DAYS_2"] / 365.25), 1
@@ -660,7 +2704,7 @@ df_condition_duration_3_years_mean = df_condition_duration_3.select(
 
 df_condition_duration_3_years_mean.display()
 
-# Em média um paciente contrai uma condição ou doença durante 4.6 anos.
+# Em média um paciente contrai uma condição ou doença durante 4.6 anos (valor obtido com o cálculo anterior por linha de 'conditions', antes da junção das linhas em episódios ('condition_episodes')).
 
 # COMMAND ----------
 
@@ -688,11 +2732,63 @@ df_condition_chronic.display()
 
 # COMMAND ----------
 
-df_condition_chronic_2 = df_condition_duration_3.filter(
-    df_condition_duration_3["DESCRIPTION_DURATION_YEARS_2"] > 1
+# 'CHRONIC' indica os episódios com mais de 1 ano completo de duração ('DESCRIPTION_DURATION_YEARS_2' > 1).
+
+df_condition_duration_3 = frame_cache.get("df_condition_duration_3")
+df_condition_chronic_2 = df_condition_duration_3.filter(df_condition_duration_3["CHRONIC"])
+
+decode_codes(df_condition_chronic_2, df_condition_codes).display()
+
+# COMMAND ----------
+
+# Verificação dos filtros de doença crónica: os filtros antigos, sobre as colunas de texto (o número de anos ou 'less than 1 year'), e os novos, sobre as colunas inteiras ('int') e 'CHRONIC', selecionam as mesmas linhas.
+# O 'DataFrame' sintético tem um episódio por doente, com durações de 0 a 3000 dias e um episódio em aberto (duração nula). A média por condição é verificada com as mesmas durações (em 'double', como o resultado de 'F.round(F.avg(...))').
+
+
+def old_duration_years(days):
+    return F.when(days > 365, F.floor(days / 365.25)).otherwise("less than 1 year")
+
+
+def new_duration_years(days):
+    return F.when(days > 365, F.floor(days / 365.25)).otherwise(0).cast(IntegerType())
+
+
+chronic_check = condition_episodes(
+    spark.range(0, 3002).select(
+        F.col("id").cast("string").alias("ID"),
+        F.lit("CHECK").alias("CODE"),
+        F.to_date(F.lit("2000-01-01")).alias("START"),
+        F.when(
+            F.col("id") <= 3000,
+            F.date_add(F.to_date(F.lit("2000-01-01")), F.col("id").cast(IntegerType())),
+        ).alias("STOP"),
+        F.lit(None).cast(DateType()).alias("DEATHDATE"),
+    )
+)
+mean_check = chronic_check.select(
+    "ID", F.col("DURATION_DAYS").cast(DoubleType()).alias("DAYS_MEAN")
+)
+
+old_chronic_mean = mean_check.withColumn(
+    "YEARS_MEAN", old_duration_years(F.col("DAYS_MEAN"))
+)
+new_chronic_mean = mean_check.withColumn(
+    "DAYS_MEAN", F.col("DAYS_MEAN").cast(IntegerType())
+).withColumn("YEARS_MEAN", new_duration_years(F.col("DAYS_MEAN")))
+old_chronic_2 = chronic_check.withColumn(
+    "YEARS_2", old_duration_years(F.col("DURATION_DAYS"))
 )
+assert dict(old_chronic_mean.dtypes)["YEARS_MEAN"] == "string"
+assert dict(old_chronic_2.dtypes)["YEARS_2"] == "string"
+assert dict(new_chronic_mean.dtypes)["YEARS_MEAN"] == "int"
 
-df_condition_chronic_2.display()
+old_ids = {row.ID for row in old_chronic_mean.filter(F.col("YEARS_MEAN") > 1).collect()}
+new_ids = {row.ID for row in new_chronic_mean.filter(F.col("YEARS_MEAN") > 1).collect()}
+assert old_ids == new_ids and old_ids
+old_ids_2 = {row.ID for row in old_chronic_2.filter(F.col("YEARS_2") > 1).collect()}
+new_ids_2 = {row.ID for row in chronic_check.filter(F.col("CHRONIC")).collect()}
+assert old_ids_2 == new_ids_2 == old_ids
+print(f"Filtros de doença crónica iguais: {len(new_ids_2)} de {chronic_check.count()} episódios")
 
 # COMMAND ----------
 
@@ -707,9 +2803,9 @@ df_condition_chronic_2.display()
 
 # COMMAND ----------
 
-df_condition_chronic.count()
+row_counts.count(df_condition_chronic)
 
-# 85 doenças/condições diferentes foram classificadas como potencialmente crónicas segundo a conceito do Dr. Fauci.
+# 85 doenças/condições diferentes foram classificadas como potencialmente crónicas segundo a conceito do Dr. Fauci (valor obtido com o cálculo anterior por linha de 'conditions', antes da junção das linhas em episódios ('condition_episodes'), e com as condições agrupadas por 'DESCRIPTION' em vez de 'CODE_KEY').
 
 # COMMAND ----------
 
@@ -718,9 +2814,10 @@ df_condition_chronic.count()
 
 # COMMAND ----------
 
-df_condition_chronic_2.count()
+row_counts.count(df_condition_chronic_2)
 
-# 13174 doentes foram classificados com doenças potencialmente crónicas segundo o conceito do Dr. Fauci.
+# 13174 doentes foram classificados com doenças potencialmente crónicas segundo o conceito do Dr. Fauci (valor obtido com o cálculo anterior por linha de 'conditions', antes da junção das linhas em episódios ('condition_episodes')).
+# A contagem é feita por episódio crónico (doente, condição), pelo que um doente com várias doenças crónicas é contado várias vezes.
 
 # COMMAND ----------
 
@@ -734,17 +2831,6 @@ df_condition_chronic_2.count()
 
 # COMMAND ----------
 
-# mudar o 'datatype' da variável para inteiro de forma a facilitar os cálculos pretendidos.
-
-df_condition_chronic = df_condition_chronic.withColumn(
-    "DESCRIPTION_DURATION_YEARS_MEAN",
-    df_condition_chronic["DESCRIPTION_DURATION_YEARS_MEAN"].cast(IntegerType()),
-)
-
-df_condition_chronic.printSchema()
-
-# COMMAND ----------
-
 # Duranção máxima (consideração a duração média por condição).
 
 max_chronic = df_condition_chronic.select(
@@ -785,17 +2871,6 @@ df_condition_chronic_mean.display()
 
 # COMMAND ----------
 
-# Mudar o datatype da variável para inteiro de forma a facilitar os cálculos pretendidos.
-
-df_condition_chronic_2 = df_condition_chronic_2.withColumn(
-    "DESCRIPTION_DURATION_YEARS_2",
-    df_condition_chronic_2["DESCRIPTION_DURATION_YEARS_2"].cast(IntegerType()),
-)
-
-df_condition_chronic_2.printSchema()
-
-# COMMAND ----------
-
 # Duranção máxima (consideração a duração da condição por paciente).
 
 max_chronic_2 = df_condition_chronic_2.select(
@@ -832,26 +2907,32 @@ df_condition_chronic_mean_2.display()
 # COMMAND ----------
 
 # Através de '.join()', uni a tabela com a duração da condição por paciente ('df_condition_duration_3') e a tabela que contém os nomes dos pacientes ('df_patients').
+# A junção é feita com a mesma dimensão de doentes da pergunta 10 ('df_patients_dim'), reduzida ao 'ID' e aos nomes, através de 'dimension_join'.
 # Selecionei apenas as colunas de interesse para a análise.
 # Criei uma nova coluna através da concatenação das colunas com o primeiro e o último nome dos pacientes, respetivamente.
 # Filtrei o Dataframe para incluir apenas os doentes com doenças crónicas, ou seja doenças com duração superior a 1 ano (segundo o Dr. Fauci).
 
-top10_chronic = df_condition_duration_3.join(df_patients, on="ID", how="inner")
+top10_chronic = dimension_join(
+    frame_cache.get("df_condition_duration_3"),
+    frame_cache.get("df_patients_dim").select("ID", "FIRST", "LAST"),
+    "ID",
+)
 
 top10_chronic = top10_chronic.select(
     "ID",
     "FIRST",
     "LAST",
-    "DESCRIPTION",
+    "CODE_KEY",
     "CONDITION_DURATION_DAYS_2",
     "DESCRIPTION_DURATION_YEARS_2",
+    "CHRONIC",
 )
 top10_chronic = top10_chronic.withColumn(
     "FULL_NAME", F.concat(top10_chronic["FIRST"], F.lit(" "), top10_chronic["LAST"])
 )
 top10_chronic = top10_chronic.drop("FIRST", "LAST")
 
-top10_chronic = top10_chronic.filter(top10_chronic["DESCRIPTION_DURATION_YEARS_2"] >= 2)
+top10_chronic = top10_chronic.filter(top10_chronic["CHRONIC"])
 
 # COMMAND ----------
 
@@ -860,7 +2941,7 @@ top10_chronic = top10_chronic.filter(top10_chronic["DESCRIPTION_DURATION_YEARS_2
 # Desta forma obtenho os nomes (primeiro e último) do 'Top 10 pessoas com mais doenças crónicas'.
 
 top10_chronic_count = top10_chronic.groupBy("FULL_NAME").agg(
-    F.count_distinct("DESCRIPTION").alias("TOP10_CHRONIC_COUNT")
+    F.count_distinct("CODE_KEY").alias("TOP10_CHRONIC_COUNT")
 )
 top10_chronic_count = top10_chronic_count.orderBy(
     "TOP10_CHRONIC_COUNT", ascending=False
@@ -870,24 +2951,70 @@ top10_chronic_count.display()
 
 # COMMAND ----------
 
+# Comparação, em dados sintéticos, entre a junção por 'shuffle' ('SortMergeJoin') e 'dimension_join'.
+# O número de condições por doente segue uma distribuição de Zipf, pelo que poucos doentes concentram muitas condições (dados enviesados, 'skew').
+# 'dimension_join' é medido em 'broadcast' (dimensão pequena) e com 'salting' das chaves mais frequentes (forçado com 'broadcast_threshold=-1').
+
+synthetic_patients = 20000
+synthetic_counts = np.minimum(
+    np.random.default_rng(42).zipf(1.5, synthetic_patients), 200000
+)
+synthetic_dim = spark.range(synthetic_patients).select(
+    F.col("id").cast("string").alias("ID"), F.lit("name").alias("FIRST")
+)
+synthetic_fact = spark.createDataFrame(
+    pd.DataFrame({"ID": np.arange(synthetic_patients).astype(str), "N": synthetic_counts})
+).select("ID", F.explode(F.sequence(F.lit(1), F.col("N"))).alias("CONDITION"))
+
+join_benchmark = []
+for label, join_function in [
+    (
+        "Shuffle join (SortMergeJoin)",
+        lambda: synthetic_fact.join(synthetic_dim.hint("merge"), on="ID"),
+    ),
+    ("dimension_join - broadcast", lambda: dimension_join(synthetic_fact, synthetic_dim, "ID")),
+    (
+        "dimension_join - salting",
+        lambda: dimension_join(synthetic_fact, synthetic_dim, "ID", broadcast_threshold=-1),
+    ),
+]:
+    joined = join_function()
+    _, benchmark = measure_jobs(
+        lambda: joined.write.format("noop").mode("overwrite").save(), label
+    )
+    benchmark["Estratégia"] = join_strategy(joined)
+    join_benchmark.append(benchmark)
+
+display(pd.DataFrame(join_benchmark))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ##### 15. Identifique qual é o código que indica o peso do doente. 
 
 # COMMAND ----------
 
 # importação e leitura de 'df_observations' desde o SF, com recurso às propriedades da classe 'DatabricksSnowflakeConnection' previamente definida.
+# A leitura foi pedida no início da EDA ('eda_catalog').
+# O valor de cada observação já vem separado no ETL em 'VALUE_NUM' (valores numéricos, 'double') e 'VALUE_TEXT' (valores de texto).
 
-df_observations = francisco.read_table(
-    "EDIT2023", "PROJETO_FINAL", "DF_OBSERVATIONS", query=None, type=True
-)
+df_observations = eda_catalog.df_observations
 df_observations.display()
 
 # COMMAND ----------
 
 # A descrição 'Body Weight' indica o peso do doente.
-
-df_body_weight = df_observations.filter(df_observations["DESCRIPTION"] == "Body Weight")
-df_body_weight.count()
+# O filtro é enviado para a leitura ('where'), pelo que apenas as linhas do peso são lidas.
+
+df_body_weight = francisco.read_table(
+    "EDIT2023",
+    "PROJETO_FINAL",
+    "DF_OBSERVATIONS",
+    columns=["DATE", "PATIENT", "VALUE_NUM", "UNITS"],
+    where=[("DESCRIPTION", "=", "Body Weight")],
+    prefer_cache=True,
+)
+row_counts.count(df_body_weight)
 
 # COMMAND ----------
 
@@ -895,25 +3022,29 @@ df_body_weight.count()
 # Fiz também a verificação de outras unidades de peso, como 'lb' e 'oz', mas não obtive resultados.
 
 df_body_weight_2 = df_observations.filter(df_observations['UNITS'] == 'kg')
-df_body_weight_2.count()
+row_counts.count(df_body_weight_2)
 
 # COMMAND ----------
 
 # Fiz também a verificação de outras unidades de peso corporal, como 'lb', 'oz', e 'st', mas não obtive resultados.
 
 df_body_weight_lb_oz = df_observations.filter(df_observations['UNITS'].isin('lb', 'oz', 'st'))
-df_body_weight_lb_oz.count()
+row_counts.count(df_body_weight_lb_oz)
 
 # COMMAND ----------
 
 # Pelos motivos referidos nas células anteriores, filtrei o Dataframe por: ['DESCRIPTION'] == 'Body Weight' & (['UNITS'] == 'kg'.
 # De forma a ter a certeza quue obtenho apenas os dados relativos ao peso dos pacientes em kg.
 
-df_weight = df_observations.filter(
-    (df_observations["DESCRIPTION"] == "Body Weight")
-    & (df_observations["UNITS"] == "kg")
+df_weight = francisco.read_table(
+    "EDIT2023",
+    "PROJETO_FINAL",
+    "DF_OBSERVATIONS",
+    columns=["DATE", "PATIENT", "VALUE_NUM", "UNITS"],
+    where=[("DESCRIPTION", "=", "Body Weight"), ("UNITS", "=", "kg")],
+    prefer_cache=True,
 )
-df_weight.count()
+row_counts.count(df_weight)
 
 # COMMAND ----------
 
@@ -929,60 +3060,114 @@ df_weight.count()
 
 # COMMAND ----------
 
-# Para o cálculo do 'BMI' é necessário onter a altura do paciente.
+# Para o cálculo do 'BMI' é necessário obter o peso e a altura do paciente.
+# Ambos são lidos da tabela de sinais vitais 'DF_VITALS', construída no ETL a partir de 'DF_OBSERVATIONS': uma linha por (doente, data), com uma coluna numérica por sinal vital, já convertida para unidades SI (peso em 'kg' e altura em 'm').
+# Apenas as colunas necessárias são lidas ('columns'), em vez de filtrar todas as observações por 'DESCRIPTION'.
 
-df_body_height = df_observations.filter(df_observations["DESCRIPTION"] == "Body Height")
-df_body_height.count()
+df_vitals = francisco.read_table(
+    "EDIT2023",
+    "PROJETO_FINAL",
+    "DF_VITALS",
+    columns=["PATIENT", "DATE", "WEIGHT_KG", "HEIGHT_M"],
+    prefer_cache=True,
+)
 
 # COMMAND ----------
 
 # Mantive no DF apenas as colunas de interesse para o cálculo.
 # Alterei o nome da coluna que contém o valor do peso para 'WEIGHT(KG)'.
-# Desta forma já não necessito de manter as colunas 'DESCRIPTION' e 'UNITS', porque o novo nome da coluna já cumpre essa 'função'.
 
-df_body_weight = df_body_weight.drop(
-    "DESCRIPTION", "UNITS", "ENCOUNTER", "TYPE", "CODE"
+df_body_weight_renamed = df_vitals.filter(F.col("WEIGHT_KG").isNotNull()).select(
+    "DATE", "PATIENT", F.col("WEIGHT_KG").alias("WEIGHT(KG)")
 )
-df_body_weight_renamed = df_body_weight.withColumnRenamed("VALUE", "WEIGHT(KG)")
 
 df_body_weight_renamed.display()
 
 # COMMAND ----------
 
 # Mantive no DF apenas as colunas de interesse para o cálculo.
-# Alterei o nome da coluna que contém o valor da altura para 'HEIGHT(CM)'.
-# Desta forma já não necessito de manter as colunas 'DESCRIPTION' e 'UNITS', porque o novo nome da coluna já cumpre essa 'função'.
-
-df_body_height = df_body_height.drop(
-    "DESCRIPTION", "UNITS", "ENCOUNTER", "TYPE", "CODE", "DATE"
+# Alterei o nome da coluna que contém o valor da altura para 'HEIGHT(M)'.
+# A coluna 'DATE' é mantida, porque cada peso é associado à altura medida na mesma data ou na data anterior mais próxima; a data dessa altura fica em 'HEIGHT_DATE'.
+
+df_body_height_renamed = df_vitals.filter(F.col("HEIGHT_M").isNotNull()).select(
+    "DATE",
+    "PATIENT",
+    F.col("HEIGHT_M").alias("HEIGHT(M)"),
+    F.col("DATE").alias("HEIGHT_DATE"),
 )
-df_body_height_renamed = df_body_height.withColumnRenamed("VALUE", "HEIGHT(CM)")
 
 df_body_height_renamed.display()
 
 # COMMAND ----------
 
-# Para facilitar o cálculo do BMI, juntei os dois DFs do peso e da altura obtidos anterioemente, através de '.join()'.
+# Para facilitar o cálculo do BMI, juntei os dois DFs do peso e da altura obtidos anterioemente.
+# A junção apenas pelo 'PATIENT' combinava todos os pesos com todas as alturas de cada doente (por exemplo 30 pesos x 30 alturas = 900 linhas), misturando medições feitas com anos de diferença.
+# Com 'asof_join' cada peso é associado à altura do mesmo doente medida na mesma data ou na data anterior mais próxima: uma linha por peso.
 
-df_bmi = df_body_height_renamed.join(df_body_weight_renamed, on="PATIENT", how="inner")
+df_bmi = asof_join(df_body_weight_renamed, df_body_height_renamed, "PATIENT", "DATE")
 
 df_bmi.display()
 
 # COMMAND ----------
 
-# Para facilitar o cáluclo do BMI mudei os 'datatypes' para inteiros.
-df_bmi = df_bmi.withColumn("WEIGHT(KG)", df_bmi["WEIGHT(KG)"].cast(IntegerType()))
-df_bmi = df_bmi.withColumn("HEIGHT(CM)", df_bmi["HEIGHT(CM)"].cast(IntegerType()))
-
-# Cálculo do BMI a partir da fórmula (tive de dividir 'HEIGHT(CM)' por 100 para passar de 'cm' para 'm', de acordo com a fórmula).
+# O peso e a altura já são numéricos ('double') e estão nas unidades da fórmula ('kg' e 'm'), pelo que não é necessária nenhuma conversão.
+# Cálculo do BMI a partir da fórmula.
 df_bmi = df_bmi.withColumn(
-    "BMI", F.round(df_bmi["WEIGHT(KG)"] / (df_bmi["HEIGHT(CM)"] / 100) ** 2, 1)
+    "BMI", F.round(df_bmi["WEIGHT(KG)"] / df_bmi["HEIGHT(M)"] ** 2, 1)
 )
 
 df_bmi.display()
 
 # COMMAND ----------
 
+# Distribuição do BMI ('histogram', calculado no 'cluster').
+
+display(histogram(df_bmi, "BMI", bins=50, method="fixed"))
+
+# COMMAND ----------
+
+# Comparação, em dados sintéticos com 10 a 100 medições de peso e de altura por doente, entre a junção apenas pelo 'PATIENT' e 'asof_join': número de linhas do resultado e tempo de execução.
+
+synthetic_rng = np.random.default_rng(42)
+synthetic_observations = pd.DataFrame(
+    [
+        (str(patient), pd.Timestamp("2000-01-01") + pd.Timedelta(days=int(day)), 70)
+        for patient in range(2000)
+        for day in synthetic_rng.choice(7300, synthetic_rng.integers(10, 101), replace=False)
+    ],
+    columns=["PATIENT", "DATE", "VALUE"],
+)
+synthetic_weight = spark.createDataFrame(synthetic_observations).withColumnRenamed(
+    "VALUE", "WEIGHT(KG)"
+)
+synthetic_height = (
+    spark.createDataFrame(synthetic_observations.sample(frac=1.0, random_state=1))
+    .withColumnRenamed("VALUE", "HEIGHT(CM)")
+    .withColumn("HEIGHT_DATE", F.col("DATE"))
+)
+
+asof_benchmark = []
+for label, join_function in [
+    (
+        "Junção por 'PATIENT'",
+        lambda: synthetic_height.drop("DATE", "HEIGHT_DATE").join(
+            synthetic_weight, on="PATIENT", how="inner"
+        ),
+    ),
+    (
+        "asof_join",
+        lambda: asof_join(synthetic_weight, synthetic_height, "PATIENT", "DATE"),
+    ),
+]:
+    joined = join_function()
+    rows, benchmark = measure_jobs(lambda: joined.count(), label)
+    benchmark["Linhas"] = rows
+    asof_benchmark.append(benchmark)
+
+display(pd.DataFrame(asof_benchmark))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ##### 17. Cria uma classificação do BMI segundo a seguintes condições:
 # MAGIC ###### - Menos de 18,5: Abaixo do peso ('Underweight');
@@ -1004,8 +3189,10 @@ df_bmi = df_bmi.withColumn(
     .when(df_bmi["BMI"] >= 40, "Class 3 Obesity")
     .otherwise(df_bmi["BMI"]),
 )
+# 'df_bmi' é reutilizado nas perguntas 17 e 18 (utilizações previstas em 'FRAME_USES'): fica em cache.
+df_bmi = frame_cache.register("df_bmi", df_bmi)
 
-df_bmi.display()
+frame_cache.get("df_bmi").display()
 
 # COMMAND ----------
 
@@ -1017,16 +3204,21 @@ df_bmi.display()
 # Contagem de doentes com anomalias de peso.
 # Ou seja, todos os doentes em que 'BMI_CLASS' não seja igual a 'Healthy Weight'.
 
-df_bmi_anomaly = df_bmi.filter(df_bmi["BMI_CLASS"] != "Healthy Weight")
-df_bmi_anomaly.count()
+df_bmi = frame_cache.get("df_bmi")
+df_bmi_anomaly = frame_cache.register(
+    "df_bmi_anomaly",
+    df_bmi.filter(df_bmi["BMI_CLASS"] != "Healthy Weight"),
+    parents=["df_bmi"],
+)
+row_counts.count(frame_cache.get("df_bmi_anomaly"))
 
-# 69493 doentes tem anomalias de peso.
+# 69493 doentes tem anomalias de peso (valor obtido com a junção anterior apenas por 'PATIENT', que combinava todos os pesos com todas as alturas).
 
 # COMMAND ----------
 
 # Na seguinte tabela é possivel verificar quais os pacientes/doentes ('PATIENT') que apresentam anomalias no peso.
 
-df_bmi_anomaly.display()
+frame_cache.get("df_bmi_anomaly").display()
 
 # COMMAND ----------
 
@@ -1040,11 +3232,11 @@ df_bmi_anomaly.display()
 
 # COMMAND ----------
 
-# De forma a facilmente aceder ao resultado de 'avg_bmi' e de 'stddev_bmi', para assim determinar o "limite superior", utilizei o método '.collect()'.
-# Método '.collect()' converte o resultado do cálculo numa lista de linhas ('Rows'). Neste caso, teríamos uma lista com uma única 'Row'.
+# A média ('avg_bmi') e o desvio padrão ('stddev_bmi') do BMI são calculados numa única passagem sobre 'df_bmi' (ver 'describe_numeric').
 
-avg_bmi = df_bmi.agg(F.avg("BMI").alias("avg_bmi")).collect()[0]["avg_bmi"]
-stddev_bmi = df_bmi.agg(F.stddev("BMI").alias("stddev_bmi")).collect()[0]["stddev_bmi"]
+bmi_stats = describe_numeric(frame_cache.get("df_bmi"), ["BMI"])
+avg_bmi = bmi_stats.loc["BMI", "mean"]
+stddev_bmi = bmi_stats.loc["BMI", "stddev"]
 
 
 superior_limit = avg_bmi + (3 * stddev_bmi)
@@ -1073,7 +3265,7 @@ print(inferior_limit)
 # Por isso tem o valor booleano de 'false', pois os seus valores de 'BMI' estão a baixo do limite inferior e acima do limite superior, respetivamente.
 # As restantes classificações tem o valor booleano 'true', uma vez que os seus valores de 'BMI' estão dentro dos limites definidos.
 
-df_bmi_anomaly = df_bmi_anomaly.withColumn(
+df_bmi_anomaly = frame_cache.get("df_bmi_anomaly").withColumn(
     "WITHIN_INTERVALS(?)",
     F.when(
         (inferior_limit <= df_bmi["BMI"]) & (df_bmi["BMI"] <= superior_limit), True
@@ -1081,3 +3273,70 @@ df_bmi_anomaly = df_bmi_anomaly.withColumn(
 )
 
 df_bmi_anomaly.display()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Relatório da cache ('frame_cache')
+
+# COMMAND ----------
+
+# Utilizações previstas e efetivas de cada DataFrame em cache, memória ainda ocupada, contagens da cache de resultados ('result_cache') e tempo total da EDA (desde a definição das funções auxiliares).
+# Para medir o ganho da cache basta correr a EDA com 'FrameCache(enabled=False)' e comparar o tempo total.
+
+frame_cache.release_finished()
+display(frame_cache.stats())
+display(frame_cache.memory())
+print(result_cache.stats())
+print({"Tempo total da EDA (segundos)": round(time.time() - eda_start_time, 2)})
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Leituras antecipadas ('read_table_async') com uma fonte lenta
+
+# COMMAND ----------
+
+# Comparação do tempo total das três leituras da EDA, intercaladas com o trabalho das perguntas, com leituras sequenciais e com leituras antecipadas.
+# 'SlowSource' substitui o SF por uma fonte local com uma latência fixa por leitura ('latency'); o trabalho de cada pergunta é uma agregação sobre a tabela lida.
+# Com leituras antecipadas, as latências das três leituras sobrepõem-se entre si e ao trabalho das perguntas.
+
+
+class SlowSource(DatabricksSnowflakeConnection):
+    def __init__(self, latency):
+        super().__init__(
+            "local", "local", "local", "local", "local", "local", "local", source_format="noop"
+        )
+        self.latency = latency
+
+    def read_table(self, db_read, schema_read, table_read, raise_errors=False, **kwargs):
+        time.sleep(self.latency)
+        return spark.range(1000000).withColumn("TABLE", F.lit(table_read))
+
+
+def run_reads(source, prefetch):
+    tables = ("DF_PATIENTS", "DF_CONDITIONS", "DF_OBSERVATIONS")
+    start_time = time.time()
+    futures = {
+        table: source.read_table_async("EDIT2023", "PROJETO_FINAL", table)
+        for table in tables
+        if prefetch
+    }
+    for table in tables:
+        if prefetch:
+            df = futures[table].result()
+        else:
+            df = source.read_table("EDIT2023", "PROJETO_FINAL", table)
+        df.groupBy((F.col("id") % 100).alias("KEY")).count().collect()
+    return round(time.time() - start_time, 2)
+
+
+slow_source = SlowSource(latency=5)
+display(
+    pd.DataFrame(
+        [
+            {"Leituras": "sequenciais", "Tempo total (segundos)": run_reads(slow_source, False)},
+            {"Leituras": "antecipadas", "Tempo total (segundos)": run_reads(slow_source, True)},
+        ]
+    )
+)